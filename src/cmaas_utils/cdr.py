@@ -4,26 +4,59 @@ from cdr_schemas.feature_results import FeatureResults
 from cdr_schemas.cdr_responses.legend_items import LegendItemResponse
 from cdr_schemas.cdr_responses.area_extractions import AreaExtractionResponse
 
-from typing import List
+import numpy as np
+import shapely
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Iterable, List, Tuple
 
-from .types import AreaBoundary, CMAAS_Map, Layout, Legend, MapUnit, MapUnitType, MapUnitSegmentation, Provenance
+from .types import AreaBoundary, CMAAS_Map, Layout, Legend, MapUnit, MapUnitType, MapUnitSegmentation, Provenance, construct_model
 
 # region CDR Common
-def exportMapToCDR(map_data: CMAAS_Map, cog_id:str='', system:str='UIUC', system_version:str='0.1') -> FeatureResults:
-    """Exports CMAAS map object to a CDR feature results object."""
+def exportMapToCDR(map_data: CMAAS_Map, cog_id:str='', system:str='UIUC', system_version:str='0.1', trusted:bool=False, workers:int=1) -> FeatureResults:
+    """Exports CMAAS map object to a CDR feature results object. If trusted is set the line and polygon features are
+    built with model_construct, skipping pydantic validation of geometry that is already known to be valid. If workers
+    is greater than 1 the result for each map unit is built on a pool of that many processes. Results are in legend
+    order either way."""
     cdr_result = FeatureResults(cog_id=cog_id, system=system, system_version=system_version)
-    # Export Map Unit Data (Legend and Segmentation)
-    for feature in map_data.legend.features:
-        if feature.type == MapUnitType.POINT:
-            cdr_result.point_feature_results.append(_build_CDR_point_feature(feature, map_data.legend.provenance))
+    # Partition the legend by type
+    units = {MapUnitType.POINT : [], MapUnitType.LINE : [], MapUnitType.POLYGON : []}
     for feature in map_data.legend.features:
-        if feature.type == MapUnitType.LINE:
-            cdr_result.line_feature_results.append(_build_CDR_line_feature(feature, map_data.legend.provenance))
-    for feature in map_data.legend.features:
-        if feature.type == MapUnitType.POLYGON:
-            cdr_result.polygon_feature_results.append(_build_CDR_poly_feature(feature, map_data.legend.provenance))
+        if feature.type in units:
+            units[feature.type].append(feature)
+    unit_types = [unit_type for unit_type, features in units.items() for _ in features]
+    features = [feature for features in units.values() for feature in features]
+
+    # Export Map Unit Data (Legend and Segmentation)
+    if workers is not None and workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_build_CDR_feature, unit_types, [_without_mask(f) for f in features], repeat(map_data.legend.provenance), repeat(trusted)))
+    else:
+        results = [_build_CDR_feature(*args) for args in zip(unit_types, features, repeat(map_data.legend.provenance), repeat(trusted))]
+
+    for unit_type, result in zip(unit_types, results):
+        if unit_type == MapUnitType.POINT:
+            cdr_result.point_feature_results.append(result)
+        elif unit_type == MapUnitType.LINE:
+            cdr_result.line_feature_results.append(result)
+        elif unit_type == MapUnitType.POLYGON:
+            cdr_result.polygon_feature_results.append(result)
     return cdr_result
 
+def _build_CDR_feature(unit_type: MapUnitType, feature: MapUnit, legend_provenance: Provenance, trusted:bool=False):
+    if unit_type == MapUnitType.POINT:
+        return _build_CDR_point_feature(feature, legend_provenance)
+    elif unit_type == MapUnitType.LINE:
+        return _build_CDR_line_feature(feature, legend_provenance, trusted)
+    else:
+        return _build_CDR_poly_feature(feature, legend_provenance, trusted)
+
+def _without_mask(feature: MapUnit) -> MapUnit:
+    """Shallow copy of a map unit without its segmentation mask, which the CDR export doesn't use, so it isn't sent to worker processes."""
+    if feature.segmentation is None or feature.segmentation.mask is None:
+        return feature
+    return feature.model_copy(update={'segmentation' : feature.segmentation.model_copy(update={'mask' : None})})
+
 def _build_CDR_provenance(provenance: Provenance) -> cdr_schemas.common.ModelProvenance:
     return cdr_schemas.common.ModelProvenance(model=provenance.name, model_version=provenance.version)
 # endregion CDR Common
@@ -72,9 +105,9 @@ def _build_CDR_point_property(provenance: Provenance) -> PointProperties:
 
 # region Export CDR Line
 from cdr_schemas.features.line_features import LineLegendAndFeaturesResult, LineFeatureCollection, LineFeature, Line, LineProperties
-def _build_CDR_line_feature(feature: MapUnit, legend_provenance: Provenance) -> LineLegendAndFeaturesResult:
+def _build_CDR_line_feature(feature: MapUnit, legend_provenance: Provenance, trusted:bool=False) -> LineLegendAndFeaturesResult:
     if feature.segmentation is not None and feature.segmentation.geometry is not None:
-        line_collection = _build_CDR_line_feature_collection(feature.segmentation)
+        line_collection = _build_CDR_line_feature_collection(feature.segmentation, trusted)
     else:
         line_collection = None
     line_feature = LineLegendAndFeaturesResult(
@@ -88,32 +121,32 @@ def _build_CDR_line_feature(feature: MapUnit, legend_provenance: Provenance) ->
         line_features=line_collection)
     return line_feature
 
-def _build_CDR_line_feature_collection(segmentation: MapUnitSegmentation) -> LineFeatureCollection:
+def _build_CDR_line_feature_collection(segmentation: MapUnitSegmentation, trusted:bool=False) -> LineFeatureCollection:
     line_features = []
     for line in segmentation.geometry:
         line_features.append(
-            LineFeature(
+            construct_model(LineFeature, trusted,
                 id='None',
-                geometry=_build_CDR_line(line),
-                properties=_build_CDR_line_property(segmentation.provenance)
+                geometry=_build_CDR_line(line, trusted),
+                properties=_build_CDR_line_property(segmentation.provenance, trusted)
             )
         )
     
-    return LineFeatureCollection(features=line_features)
+    return construct_model(LineFeatureCollection, trusted, features=line_features)
 
-def _build_CDR_line(geometry: List[List[float]]) -> Line:
-    return Line(coordinates=geometry)
+def _build_CDR_line(geometry: List[List[float]], trusted:bool=False) -> Line:
+    return construct_model(Line, trusted, coordinates=geometry)
 
-def _build_CDR_line_property(provenance: Provenance) -> LineProperties:
-    return LineProperties(
+def _build_CDR_line_property(provenance: Provenance, trusted:bool=False) -> LineProperties:
+    return construct_model(LineProperties, trusted,
         model=provenance.name,
         model_version=provenance.version)
 
 # region Export CDR Polygon
 from cdr_schemas.features.polygon_features import PolygonLegendAndFeaturesResult, PolygonFeatureCollection, PolygonFeature, Polygon, PolygonProperties
-def _build_CDR_poly_feature(feature: MapUnit, legend_provenance: Provenance) -> PolygonLegendAndFeaturesResult:
+def _build_CDR_poly_feature(feature: MapUnit, legend_provenance: Provenance, trusted:bool=False) -> PolygonLegendAndFeaturesResult:
     if feature.segmentation is not None and feature.segmentation.geometry is not None:
-        poly_collection = _build_CDR_poly_feature_collection(feature.segmentation)
+        poly_collection = _build_CDR_poly_feature_collection(feature.segmentation, trusted)
     else:
         poly_collection = None
     poly_feature = PolygonLegendAndFeaturesResult(
@@ -130,29 +163,33 @@ def _build_CDR_poly_feature(feature: MapUnit, legend_provenance: Provenance) ->
         map_unit=[])
     return poly_feature
 
-def _build_CDR_poly_feature_collection(segmentation: MapUnitSegmentation) -> PolygonFeatureCollection:
+def _build_CDR_poly_feature_collection(segmentation: MapUnitSegmentation, trusted:bool=False) -> PolygonFeatureCollection:
+    # Change Shapely geometries to CDR Format, pulling the coordinates of every ring out in bulk
+    polygons = segmentation.geometry_array()
+    rings, ring_polygon = shapely.get_rings(polygons, return_index=True)
+    coords, coord_ring = shapely.get_coordinates(rings, return_index=True)
+    coord_offsets = np.concatenate([[0], np.cumsum(np.bincount(coord_ring, minlength=len(rings)))]).tolist()
+    ring_offsets = np.concatenate([[0], np.cumsum(np.bincount(ring_polygon, minlength=len(polygons)))]).tolist()
+    coords = coords.tolist()
+    ring_coords = [coords[coord_offsets[i]:coord_offsets[i+1]] for i in range(len(rings))]
+
     poly_features = []
-    for polygon in segmentation.geometry:
-        # Change Shapely geometries to CDR Format
-        poly_geometry = []
-        poly_geometry.append([[*point] for point in polygon.exterior.coords])
-        for interior in polygon.interiors:
-            poly_geometry.append([[*point] for point in interior.coords])
+    for i in range(len(polygons)):
         poly_features.append(
-            PolygonFeature(
+            construct_model(PolygonFeature, trusted,
                 id='None',
-                geometry=_build_CDR_polygon(poly_geometry), 
-                properties=_build_CDR_polygon_property(segmentation.provenance)
+                geometry=_build_CDR_polygon(ring_coords[ring_offsets[i]:ring_offsets[i+1]], trusted),
+                properties=_build_CDR_polygon_property(segmentation.provenance, trusted)
             )
         )
     
-    return PolygonFeatureCollection(features=poly_features)
+    return construct_model(PolygonFeatureCollection, trusted, features=poly_features)
 
-def _build_CDR_polygon(geometry: List[List[List[float]]]) -> Polygon:
-    return Polygon(coordinates=geometry)
+def _build_CDR_polygon(geometry: List[List[List[float]]], trusted:bool=False) -> Polygon:
+    return construct_model(Polygon, trusted, coordinates=geometry)
 
-def _build_CDR_polygon_property(provenance: Provenance) -> PolygonProperties:
-    return PolygonProperties(model=provenance.name, model_version=provenance.version)  
+def _build_CDR_polygon_property(provenance: Provenance, trusted:bool=False) -> PolygonProperties:
+    return construct_model(PolygonProperties, trusted, model=provenance.name, model_version=provenance.version)  
 # endregion Export CDR Polygon
 
 # region Convert CDR to CMAAS
@@ -166,56 +203,86 @@ def convert_cdr_feature_results_to_cmaas_map(cdr_results: FeatureResults) -> CMA
     Returns:
         CMAAS_Map: A CMAAS map object.
     """
-    map_data = CMAAS_Map(name=cdr_results.cog_id, cog_id=cdr_results.cog_id)
-    # Legend 
-    legend = Legend(provenance=Provenance(name=cdr_results.system, version=cdr_results.system_version))
-    for point_feature in cdr_results.point_feature_results:
-        map_unit = MapUnit(type=MapUnitType.POINT)
-        map_unit.label = point_feature.name
-        map_unit.abbreviation = point_feature.abbreviation
-        map_unit.description = point_feature.description
-        map_unit.label_bbox = [point_feature.legend_bbox[0:2], point_feature.legend_bbox[2:4]]
-        legend.features.append(map_unit)
-    for line_feature in cdr_results.line_feature_results:
-        map_unit = MapUnit(type=MapUnitType.LINE)
-        map_unit.label = line_feature.name
-        map_unit.abbreviation = line_feature.abbreviation
-        map_unit.description = line_feature.description
-        map_unit.label_bbox = [line_feature.legend_bbox[0:2], line_feature.legend_bbox[2:4]]
-        legend.features.append(map_unit)
-    for poly_feature in cdr_results.polygon_feature_results:
-        map_unit = MapUnit(type=MapUnitType.POLYGON)
-        map_unit.label = poly_feature.label
-        map_unit.abbreviation = poly_feature.abbreviation
-        map_unit.description = poly_feature.description
-        map_unit.color = poly_feature.color
-        map_unit.pattern = poly_feature.pattern
-        map_unit.label_bbox = [poly_feature.legend_bbox[0:2], poly_feature.legend_bbox[2:4]]
-        legend.features.append(map_unit)
+    return convert_cdr_feature_results_stream_to_cmaas_map(_iter_cdr_feature_results(cdr_results))
+
+def convert_cdr_feature_results_stream_to_cmaas_map(cdr_items: Iterable[Tuple[str, Any]]) -> CMAAS_Map:
+    """
+    Convert a stream of CDR feature results fields to a CMAAS map object, such as the stream yielded by
+    io.iterCDRFeatureResults. Only one item of the stream needs to be in memory at a time. Preseves the provenance,
+    cog_id, legend and layout information. No segmentation or metadata is preserved.
+
+    Args:
+        cdr_items (Iterable[Tuple[str, Any]]): (field_name, value) tuples of a FeatureResults object. List fields have
+            one tuple per item of the list.
+
+    Returns:
+        CMAAS_Map: A CMAAS map object.
+    """
+    fields = {}
+    legend = Legend(provenance=Provenance(name=''))
+    layout = Layout(provenance=Provenance(name=''))
+    for field_name, value in cdr_items:
+        if value is None:
+            continue
+        if field_name == 'point_feature_results':
+            legend.features.append(_build_cmaas_map_unit(value, MapUnitType.POINT, value.name))
+        elif field_name == 'line_feature_results':
+            legend.features.append(_build_cmaas_map_unit(value, MapUnitType.LINE, value.name))
+        elif field_name == 'polygon_feature_results':
+            map_unit = _build_cmaas_map_unit(value, MapUnitType.POLYGON, value.label)
+            map_unit.color = value.color
+            map_unit.pattern = value.pattern
+            legend.features.append(map_unit)
+        elif field_name == 'cog_area_extractions':
+            _add_cdr_area_extraction(layout, value)
+        else:
+            fields[field_name] = value
+
+    # Provenance is set last as the system fields can come after the results in the stream
+    legend.provenance = Provenance(name=fields.get('system'), version=fields.get('system_version'))
+    layout.provenance = Provenance(name=fields.get('system'), version=fields.get('system_version'))
+    map_data = CMAAS_Map(name=fields.get('cog_id'), cog_id=fields.get('cog_id'))
     map_data.legend = legend
-    # Layout
-    layout = Layout(provenance=Provenance(name=cdr_results.system, version=cdr_results.system_version))
-    for ae in cdr_results.cog_area_extractions:
-        if ae.category == AreaType.Map_Area:
-            if len(layout.map) > 0:
-                if ae.confidence > layout.map[0].confidence:
-                    layout.map = [AreaBoundary(geometry=ae.px_geojson.coordinates, confidence=ae.confidence)]
-            else:
-                layout.map = [AreaBoundary(geometry=ae.px_geojson.coordinates, confidence=ae.confidence)]
-        if ae.category == AreaType.Polygon_Legend_Area:
-            layout.polygon_legend.append(AreaBoundary(geometry=ae.px_geojson.coordinates, confidence=ae.confidence))
-        if ae.category == AreaType.Line_Point_Legend_Area:
-            layout.line_legend.append(AreaBoundary(geometry=ae.px_geojson.coordinates, confidence=ae.confidence))
-            layout.point_legend.append(AreaBoundary(geometry=ae.px_geojson.coordinates, confidence=ae.confidence))
-        if ae.category == AreaType.Point_Legend_Area:
-            layout.point_legend.append(AreaBoundary(geometry=ae.px_geojson.coordinates, confidence=ae.confidence))
-        if ae.category == AreaType.CrossSection:
-            layout.cross_section.append(AreaBoundary(geometry=ae.px_geojson.coordinates, confidence=ae.confidence))
-        if ae.category == AreaType.Correlation_Diagram:
-            layout.correlation_diagram.append(AreaBoundary(geometry=ae.px_geojson.coordinates, confidence=ae.confidence))
     map_data.layout = layout
     return map_data
 
+def _iter_cdr_feature_results(cdr_results: FeatureResults):
+    """Yields the (field_name, value) stream of a FeatureResults object, with one tuple per item of list fields."""
+    for field_name in type(cdr_results).model_fields:
+        value = getattr(cdr_results, field_name)
+        if isinstance(value, list):
+            for item in value:
+                yield field_name, item
+        else:
+            yield field_name, value
+
+def _build_cmaas_map_unit(feature_result, unit_type: MapUnitType, label: str) -> MapUnit:
+    map_unit = MapUnit(type=unit_type)
+    map_unit.label = label
+    map_unit.abbreviation = feature_result.abbreviation
+    map_unit.description = feature_result.description
+    map_unit.label_bbox = [feature_result.legend_bbox[0:2], feature_result.legend_bbox[2:4]]
+    return map_unit
+
+def _add_cdr_area_extraction(layout: Layout, ae):
+    if ae.category == AreaType.Map_Area:
+        if len(layout.map) > 0:
+            if ae.confidence > layout.map[0].confidence:
+                layout.map = [construct_model(AreaBoundary, True, geometry=ae.px_geojson.coordinates, confidence=ae.confidence)]
+        else:
+            layout.map = [construct_model(AreaBoundary, True, geometry=ae.px_geojson.coordinates, confidence=ae.confidence)]
+    if ae.category == AreaType.Polygon_Legend_Area:
+        layout.polygon_legend.append(construct_model(AreaBoundary, True, geometry=ae.px_geojson.coordinates, confidence=ae.confidence))
+    if ae.category == AreaType.Line_Point_Legend_Area:
+        layout.line_legend.append(construct_model(AreaBoundary, True, geometry=ae.px_geojson.coordinates, confidence=ae.confidence))
+        layout.point_legend.append(construct_model(AreaBoundary, True, geometry=ae.px_geojson.coordinates, confidence=ae.confidence))
+    if ae.category == AreaType.Point_Legend_Area:
+        layout.point_legend.append(construct_model(AreaBoundary, True, geometry=ae.px_geojson.coordinates, confidence=ae.confidence))
+    if ae.category == AreaType.CrossSection:
+        layout.cross_section.append(construct_model(AreaBoundary, True, geometry=ae.px_geojson.coordinates, confidence=ae.confidence))
+    if ae.category == AreaType.Correlation_Diagram:
+        layout.correlation_diagram.append(construct_model(AreaBoundary, True, geometry=ae.px_geojson.coordinates, confidence=ae.confidence))
+
 def convert_cdr_legend_items_to_legend(cdr_legend:List[LegendItemResponse]) -> Legend:
     """
     Convert a list of cdr_schema LegendItemResponse to a cmaas_utils Legend object.
@@ -257,23 +324,23 @@ def convert_cdr_area_extraction_to_layout(cdr_area_extraction:List[AreaExtractio
         # Map area is selected by the highest confidence
         if area.category == 'map_area':
             if len(layout.map) == 0:
-                layout.map = [AreaBoundary(geometry=area.px_geojson.coordinates, confidence=area.confidence)]
+                layout.map = [construct_model(AreaBoundary, True, geometry=area.px_geojson.coordinates, confidence=area.confidence)]
             else:
                 cur_confidence = 0
                 for map_area in layout.map:
                     if map_area.confidence is not None:
                         cur_confidence = max(cur_confidence, map_area.confidence)
                 if area.confidence > cur_confidence:
-                    layout.map = [AreaBoundary(geometry=area.px_geojson.coordinates, confidence=area.confidence)]
+                    layout.map = [construct_model(AreaBoundary, True, geometry=area.px_geojson.coordinates, confidence=area.confidence)]
         # All other areas are concatanated to the layout
         if area.category == 'line_point_legend_area':
-            layout.line_legend.append(AreaBoundary(geometry=area.px_geojson.coordinates, confidence=area.confidence))
-            layout.point_legend.append(AreaBoundary(geometry=area.px_geojson.coordinates, confidence=area.confidence))
+            layout.line_legend.append(construct_model(AreaBoundary, True, geometry=area.px_geojson.coordinates, confidence=area.confidence))
+            layout.point_legend.append(construct_model(AreaBoundary, True, geometry=area.px_geojson.coordinates, confidence=area.confidence))
         if area.category == 'polygon_legend_area':
-            layout.polygon_legend.append(AreaBoundary(geometry=area.px_geojson.coordinates, confidence=area.confidence))
+            layout.polygon_legend.append(construct_model(AreaBoundary, True, geometry=area.px_geojson.coordinates, confidence=area.confidence))
         if area.category == 'cross_section':
-            layout.cross_section.append(AreaBoundary(geometry=area.px_geojson.coordinates, confidence=area.confidence))
+            layout.cross_section.append(construct_model(AreaBoundary, True, geometry=area.px_geojson.coordinates, confidence=area.confidence))
         if area.category == 'correlation_diagram':
-            layout.correlation_diagram.append(AreaBoundary(geometry=area.px_geojson.coordinates, confidence=area.confidence))
+            layout.correlation_diagram.append(construct_model(AreaBoundary, True, geometry=area.px_geojson.coordinates, confidence=area.confidence))
     return layout
 # endregion Convert CDR to CMAAS
\ No newline at end of file
@@ -1,32 +1,142 @@
 import os
 import json
+import gzip
+import uuid
+import hashlib
+import asyncio
+import functools
+import threading
 import rasterio
 import multiprocessing
+from multiprocessing import shared_memory
 import numpy as np
+import shapely
 import geopandas as gpd
+from enum import Enum
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor
-from .types import AreaBoundary, CMAAS_Map, Layout, Legend, GeoReference, MapUnit, MapUnitType, Provenance
+from typing import Union, get_args, get_origin
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from .types import AreaBoundary, CMAAS_Map, Layout, LazyGeoTiff, Legend, GeoReference, MapUnit, MapUnitType, Provenance, RLEArray, SparseMask, affine_transform_geometry
 from rasterio.crs import CRS
+from rasterio.transform import Affine
 
 from cdr_schemas.map_results import MapResults
 from cdr_schemas.feature_results import FeatureResults
+from pydantic import BaseModel, TypeAdapter
 from pydantic.tools import parse_obj_as
-from shapely.affinity import affine_transform
+from pydantic_core import to_json
+
+# region JSON Backend
+def _msgspecLoads(data):
+    # Raise a ValueError on bad json like the other backends
+    try:
+        return msgspec.json.decode(data)
+    except msgspec.DecodeError as e:
+        raise ValueError(str(e)) from e
+
+# Only parsing goes through the backend, json is always written with pydantic-core so files don't depend on which
+# backends are installed. The backends format floats and NaN differently.
+_json_backends = {
+    'json' : json.loads
+}
+try:
+    import orjson
+    _json_backends['orjson'] = orjson.loads
+except ImportError:
+    pass
+try:
+    import msgspec
+    _json_backends['msgspec'] = _msgspecLoads
+except ImportError:
+    pass
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+_json_backend = None
+
+def setJsonBackend(name:str=None):
+    """Set the json library used to parse json files. Can be 'orjson', 'msgspec' or 'json'. If name is None the fastest
+    installed library is used. Raises a ValueError if the library is not installed. Json is always written with
+    pydantic-core regardless of the backend."""
+    global _json_backend
+    if name is None:
+        name = next(n for n in ['orjson', 'msgspec', 'json'] if n in _json_backends)
+    if name not in _json_backends:
+        msg = f'Json backend "{name}" is not available, installed backends are {list(_json_backends.keys())}'
+        raise ValueError(msg)
+    _json_backend = name
+
+def getJsonBackend() -> str:
+    """Returns the name of the json library used to parse json files."""
+    return _json_backend
+
+def _jsonLoads(data):
+    """Parse a json str or bytes with the current backend. Raises a ValueError on invalid json."""
+    return _json_backends[_json_backend](data)
+
+def _jsonDumps(obj) -> str:
+    """Serialize obj to a compact utf-8 json str. NaN and infinity are written as null so every backend can read it."""
+    return to_json(obj, inf_nan_mode='null').decode()
+
+def _openFile(filepath:Path, mode:str='r'):
+    """Open a file, transparently compressing or decompressing it if the filename ends in .gz"""
+    if str(filepath).endswith('.gz'):
+        return gzip.open(filepath, mode if 'b' in mode else mode + 't')
+    return open(filepath, mode)
+
+def _loadJsonFile(filepath:Path):
+    with _openFile(filepath, 'rb') as fh:
+        return _jsonLoads(fh.read())
+
+setJsonBackend()
+# endregion JSON Backend
+
+# region Parallel Loading
+def _parallelLoad(load_func, filepaths, args=(), threads:int=32, processes:int=None):
+    """Submits load_func for every file before collecting any results. Yields (map_name, result) as each load completes.
+    Uses a process pool with N processes when processes is set, otherwise a thread pool with N threads."""
+    if processes is not None:
+        executor = ProcessPoolExecutor(max_workers=processes)
+    else:
+        executor = ThreadPoolExecutor(max_workers=threads)
+    with executor:
+        futures = {executor.submit(load_func, filepath, *args) : filepath for filepath in filepaths}
+        try:
+            for future in as_completed(futures):
+                map_name = os.path.basename(os.path.splitext(futures[future])[0])
+                yield map_name, future.result()
+        finally:
+            # Don't start loads that will never be collected if the caller stops early
+            for future in futures:
+                future.cancel()
+# endregion Parallel Loading
 
 #region Legend
+# Registered legend formats as (matches, parser) pairs. matches takes the parsed json data and parser takes the parsed
+# json data and a type filter. The first format that matches is used, if none match the data is parsed as a Legend.
+_legend_formats = []
+
+def registerLegendFormat(matches, parser):
+    """Register a legend file format with loadLegendJson. matches(json_data) returns True if the parsed json is in the
+    format and parser(json_data, type_filter) returns a Legend from it."""
+    _legend_formats.append((matches, parser))
+
 def loadLegendJson(filepath:Path, type_filter:MapUnitType=MapUnitType.ALL()) -> Legend:
-    with open(filepath, 'r') as fh:
-        json_data = json.load(fh)
-    if json_data['version'] in ['5.0.1', '5.0.2']:
-        legend = _loadLegacyUSGSLegendJson(filepath, type_filter)
-    else:
-        legend = parse_obj_as(Legend, json_data)
-    return legend
+    json_data = _loadJsonFile(filepath)
+    return _parseLegendJson(json_data, type_filter)
+
+def _parseLegendJson(json_data, type_filter:MapUnitType=MapUnitType.ALL()) -> Legend:
+    for matches, parser in _legend_formats:
+        if matches(json_data):
+            return parser(json_data, type_filter)
+    return parse_obj_as(Legend, json_data)
+
+def _isLegacyUSGSLegendJson(json_data) -> bool:
+    return isinstance(json_data, dict) and json_data.get('version') in ['5.0.1', '5.0.2']
 
-def _loadLegacyUSGSLegendJson(filepath:Path, type_filter:MapUnitType=MapUnitType.ALL()) -> Legend:
-    with open(filepath, 'r') as fh:
-        json_data = json.load(fh)
+def _parseLegacyUSGSLegendJson(json_data, type_filter:MapUnitType=MapUnitType.ALL()) -> Legend:
     legend = Legend(provenance=Provenance(name='USGS', version='5.0.1'))
     for m in json_data['shapes']:
         # Filter out unwanted map unit types
@@ -46,99 +156,114 @@ def _loadLegacyUSGSLegendJson(filepath:Path, type_filter:MapUnitType=MapUnitType
                 if unit_type != MapUnitType.UNKNOWN:
                     unit_alias = ' '.join(unit_alias.split(' ')[:-1])
                 unit_aliases.append(unit_alias)
-        legend.features.append(MapUnit(label=unit_label, type=unit_type, aliases=unit_aliases, label_bbox=np.array(m['points']).astype(int)))
+        legend.features.append(MapUnit(label=unit_label, type=unit_type, aliases=unit_aliases, label_bbox=np.array(m['points']).astype(int).tolist()))
     return legend
 
-def parallelLoadLegends(filepaths, type_filter:MapUnitType=MapUnitType.ALL(), threads:int=32):
-    with ThreadPoolExecutor(max_workers=threads) as executor:
-        legends = {}
-        for filepath in filepaths:
-            map_name = os.path.basename(os.path.splitext(filepath)[0])
-            legends[map_name] = executor.submit(loadLegendJson, filepath, type_filter).result()
-    return legends
+registerLegendFormat(_isLegacyUSGSLegendJson, _parseLegacyUSGSLegendJson)
+
+def parallelLoadLegends(filepaths, type_filter:MapUnitType=MapUnitType.ALL(), threads:int=32, processes:int=None):
+    """Load a list of legend files concurrently. Returns a dict of map name to Legend in the same order as filepaths.
+    Uses a process pool with N processes when processes is set, otherwise a thread pool with N threads."""
+    loaded = dict(iterLoadLegends(filepaths, type_filter, threads, processes))
+    map_names = [os.path.basename(os.path.splitext(filepath)[0]) for filepath in filepaths]
+    return {map_name : loaded[map_name] for map_name in map_names}
+
+def iterLoadLegends(filepaths, type_filter:MapUnitType=MapUnitType.ALL(), threads:int=32, processes:int=None):
+    """Load a list of legend files concurrently. Yields (map_name, Legend) tuples as each file finishes loading."""
+    yield from _parallelLoad(loadLegendJson, filepaths, (type_filter,), threads, processes)
 # endregion Legend
 
 # region Layout
+# Registered layout formats as (matches, parser) pairs. matches and parser both take the parsed json data, json lines
+# files are parsed to a list of their records. The first format that matches is used, if none match the data is parsed
+# as a Layout.
+_layout_formats = []
+
+def registerLayoutFormat(matches, parser):
+    """Register a layout file format with loadLayoutJson. matches(json_data) returns True if the parsed json is in the
+    format and parser(json_data) returns a Layout from it. Json lines files are passed as a list of their records."""
+    _layout_formats.append((matches, parser))
+
 def loadLayoutJson(filepath:Path) -> Layout:
-    with open(filepath, 'r') as fh:
-        layout_version = 1
-        try:
-            for line in fh:
-                json_data = json.loads(line)
-                if json_data['name'] == 'segmentation':
-                    layout_version = 2
-                break
-        except:
-            layout_version = 1
-            pass
-        if layout_version == 1:
-            layout = _loadLegacyUnchartedLayoutv1Json(filepath)
-        elif layout_version == 2:
-            layout = _loadLegacyUnchartedLayoutv2Json(filepath)
-        else:
-            layout = parse_obj_as(Layout, json_data)
-    return layout
+    with open(filepath, 'rb') as fh:
+        json_data = _readJsonOrJsonLines(fh.read())
+    return _parseLayoutJson(json_data)
 
-def _loadLegacyUnchartedLayoutv1Json(filepath:Path) -> Layout:
-    layout = Layout(provenance=Provenance(name='Uncharted', version='0.1'))
-    with open(filepath, 'r') as fh:
-        json_data = json.load(fh)
+def _readJsonOrJsonLines(data:bytes):
+    """Parse data as a single json document, falling back to json lines. Json lines are returned as a list of records."""
+    try:
+        return _jsonLoads(data)
+    except ValueError:
+        return [_jsonLoads(line) for line in data.splitlines() if line.strip()]
+
+def _parseLayoutJson(json_data) -> Layout:
+    for matches, parser in _layout_formats:
+        if matches(json_data):
+            return parser(json_data)
+    return parse_obj_as(Layout, json_data)
+
+def _addLayoutSection(layout:Layout, section_name:str, bounds:AreaBoundary):
+    if section_name == 'map':
+        layout.map.append(bounds)
+    elif section_name == 'correlation_diagram':
+        layout.correlation_diagram.append(bounds)
+    elif section_name == 'cross_section':
+        layout.cross_section.append(bounds)
+    elif section_name == 'legend_points_lines':
+        layout.point_legend.append(bounds)
+        layout.line_legend.append(bounds)
+    elif section_name == 'legend_points':
+        layout.point_legend.append(bounds)
+    elif section_name == 'legend_lines':
+        layout.line_legend.append(bounds)
+    elif section_name == 'legend_polygons':
+        layout.polygon_legend.append(bounds)
 
+def _isLegacyUnchartedLayoutv1Json(json_data) -> bool:
+    return isinstance(json_data, list) and (len(json_data) == 0 or json_data[0].get('name') != 'segmentation')
+
+def _parseLegacyUnchartedLayoutv1Json(json_data) -> Layout:
+    layout = Layout(provenance=Provenance(name='Uncharted', version='0.1'))
     for section in json_data:
         bounds = AreaBoundary(geometry=[section['bounds']], confidence=section['confidence'])
-        if section['name'] == 'map':
-            layout.map.append(bounds)
-        elif section['name'] == 'correlation_diagram':
-            layout.correlation_diagram.append(bounds)
-        elif section['name'] == 'cross_section':
-            layout.cross_section.append(bounds)
-        elif section['name'] == 'legend_points_lines':
-            layout.point_legend.append(bounds)
-            layout.line_legend.append(bounds)
-        elif section['name'] == 'legend_points':
-            layout.point_legend.append(bounds)
-        elif section['name'] == 'legend_lines':
-            layout.line_legend.append(bounds)
-        elif section['name'] == 'legend_polygons':
-            layout.polygon_legend.append(bounds)
+        _addLayoutSection(layout, section['name'], bounds)
     return layout
 
-def _loadLegacyUnchartedLayoutv2Json(filepath:Path) -> Layout:
+def _isLegacyUnchartedLayoutv2Json(json_data) -> bool:
+    # A json lines file with a single record parses as one json document
+    if isinstance(json_data, dict):
+        return json_data.get('name') == 'segmentation'
+    return isinstance(json_data, list) and len(json_data) > 0 and json_data[0].get('name') == 'segmentation'
+
+def _parseLegacyUnchartedLayoutv2Json(json_data) -> Layout:
+    if isinstance(json_data, dict):
+        json_data = [json_data]
     layout = Layout(provenance=Provenance(name='Uncharted', version='0.2'))
-    with open(filepath, 'r') as fh:
-        for line in fh:
-            json_data = json.loads(line)
-            section_name = json_data['model']['field']
-            bounds = AreaBoundary(geometry=[json_data['bounds']], confidence=json_data['confidence'])
-            if section_name == 'map':
-                layout.map.append(bounds)
-            elif section_name == 'correlation_diagram':
-                layout.correlation_diagram.append(bounds)
-            elif section_name == 'cross_section':
-                layout.cross_section.append(bounds)
-            elif section_name == 'legend_points_lines':
-                layout.point_legend.append(bounds)
-                layout.line_legend.append(bounds)
-            elif section_name == 'legend_points':
-                layout.point_legend.append(bounds)
-            elif section_name == 'legend_lines':
-                layout.line_legend.append(bounds)
-            elif section_name == 'legend_polygons':
-                layout.polygon_legend.append(bounds)
+    for record in json_data:
+        bounds = AreaBoundary(geometry=[record['bounds']], confidence=record['confidence'])
+        _addLayoutSection(layout, record['model']['field'], bounds)
     return layout
 
-def parallelLoadLayouts(filepaths, threads:int=32):
-    with ThreadPoolExecutor(max_workers=threads) as executor:
-        layouts = {}
-        for filepath in filepaths:
-            map_name = os.path.basename(os.path.splitext(filepath)[0])
-            layouts[map_name] = executor.submit(loadLayoutJson, filepath).result()
-    return layouts
+registerLayoutFormat(_isLegacyUnchartedLayoutv1Json, _parseLegacyUnchartedLayoutv1Json)
+registerLayoutFormat(_isLegacyUnchartedLayoutv2Json, _parseLegacyUnchartedLayoutv2Json)
+
+def parallelLoadLayouts(filepaths, threads:int=32, processes:int=None):
+    """Load a list of layout files concurrently. Returns a dict of map name to Layout in the same order as filepaths.
+    Uses a process pool with N processes when processes is set, otherwise a thread pool with N threads."""
+    loaded = dict(iterLoadLayouts(filepaths, threads, processes))
+    map_names = [os.path.basename(os.path.splitext(filepath)[0]) for filepath in filepaths]
+    return {map_name : loaded[map_name] for map_name in map_names}
+
+def iterLoadLayouts(filepaths, threads:int=32, processes:int=None):
+    """Load a list of layout files concurrently. Yields (map_name, Layout) tuples as each file finishes loading."""
+    yield from _parallelLoad(loadLayoutJson, filepaths, (), threads, processes)
 # endregion Layout
 
 # region GeoTiff
-def loadGeoTiff(filepath:Path):
-    """Load a GeoTiff file. Image is in CHW format. Raises exception if image is not loaded properly. Returns a tuple of the image, crs and transform """
+def loadGeoTiff(filepath:Path, cache:'RasterCache'=None):
+    """Load a GeoTiff file. Image is in CHW format. Raises exception if image is not loaded properly. Returns a tuple of the image, crs and transform. If a cache is given the image is a read only memory map of the decoded image in the cache."""
+    if cache is not None:
+        return cache.load(filepath)
     with rasterio.open(filepath) as fh:
         image = fh.read()
         crs = fh.crs
@@ -149,75 +274,287 @@ def loadGeoTiff(filepath:Path):
     
     return image, crs, transform
 
+class RasterCache():
+    """
+    An on disk cache of decoded GeoTiff images. The first load of an image decodes it into an uncompressed .npy file in
+    the cache directory, later loads memory map that file instead of decoding the GeoTiff again. Entries are keyed by the
+    path, modification time and size of the GeoTiff so a changed file is decoded again. When the cache grows past
+    max_bytes the least recently used entries are removed.
+
+    Args:
+        cache_dir (Path): The directory to store decoded images in.
+        max_bytes (int, optional): The maximum size of the decoded images in the cache. Defaults to 64 GB.
+    """
+    def __init__(self, cache_dir:Path, max_bytes:int=64*1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def load(self, filepath:Path):
+        """Load a GeoTiff through the cache. Returns a tuple of the image as a read only memory map, crs and transform"""
+        key = self._key(filepath)
+        image_path = os.path.join(self.cache_dir, f'{key}.npy')
+        meta_path = os.path.join(self.cache_dir, f'{key}.json')
+        try:
+            image = np.load(image_path, mmap_mode='r')
+            meta = _loadJsonFile(meta_path)
+            # Mark the entry as recently used
+            os.utime(image_path)
+        except (FileNotFoundError, ValueError):
+            image, meta = self._add(filepath, image_path, meta_path)
+        crs = CRS.from_wkt(meta['crs']) if meta['crs'] is not None else None
+        transform = Affine(*meta['transform']) if meta['transform'] is not None else None
+        return image, crs, transform
+
+    def clear(self):
+        """Remove all entries from the cache."""
+        for entry in os.listdir(self.cache_dir):
+            if os.path.splitext(entry)[1] in ['.npy', '.json']:
+                os.remove(os.path.join(self.cache_dir, entry))
+
+    def _key(self, filepath:Path) -> str:
+        stat = os.stat(filepath)
+        return hashlib.sha1(f'{os.path.abspath(filepath)}:{stat.st_mtime_ns}:{stat.st_size}'.encode()).hexdigest()
+
+    def _add(self, filepath:Path, image_path:str, meta_path:str):
+        # Decode straight into the cache file, then move it into place so other readers never see a partial entry
+        tmp_path = f'{image_path}.{os.getpid()}.{uuid.uuid4().hex}.tmp'
+        with rasterio.open(filepath) as fh:
+            image = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=fh.dtypes[0], shape=(fh.count, fh.height, fh.width))
+            fh.read(out=image)
+            meta = {
+                'crs' : fh.crs.to_wkt() if fh.crs is not None else None,
+                'transform' : [fh.transform.a, fh.transform.b, fh.transform.c, fh.transform.d, fh.transform.e, fh.transform.f] if fh.transform is not None else None
+            }
+        image.flush()
+        del image
+        with open(meta_path, 'w') as fh:
+            fh.write(_jsonDumps(meta))
+        os.replace(tmp_path, image_path)
+        self._evict(keep=image_path)
+        return np.load(image_path, mmap_mode='r'), meta
+
+    def _evict(self, keep:str):
+        entries = []
+        for entry in os.listdir(self.cache_dir):
+            if entry.endswith('.npy'):
+                stat = os.stat(os.path.join(self.cache_dir, entry))
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(self.cache_dir, entry)))
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, image_path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            if image_path == keep:
+                continue
+            for entry_path in [image_path, os.path.splitext(image_path)[0] + '.json']:
+                try:
+                    os.remove(entry_path)
+                except FileNotFoundError: # Already evicted by another process
+                    pass
+            total_bytes -= size
+
+def openGeoTiff(filepath:Path):
+    """Open a GeoTiff file without reading its pixels. Returns a tuple of a LazyGeoTiff handle to the image, crs and transform"""
+    image = LazyGeoTiff(filepath)
+    return image, image.crs, image.transform
+
 def saveGeoTiff(filename, image, crs=None, transform=None):
     image = np.array(image[...], ndmin=3)
     with rasterio.open(filename, 'w', driver='GTiff', compress='lzw', height=image.shape[1], width=image.shape[2],
                        count=image.shape[0], dtype=image.dtype, crs=crs, transform=transform) as fh:
         fh.write(image)
 
-def parallelLoadGeoTiffs(filepaths, processes=multiprocessing.cpu_count()): # -> list[tuple(image, crs, transfrom)]:
-    """Load a list of filenames in parallel with N processes. Returns a list of images"""
-    p=multiprocessing.Pool(processes=processes)
-    with multiprocessing.Pool(processes) as p:
-        images = p.map(loadGeoTiff, filepaths)
+def parallelLoadGeoTiffs(filepaths, processes=multiprocessing.cpu_count(), max_in_flight:int=None): # -> list[tuple(image, crs, transfrom)]:
+    """Load a list of filenames in parallel with N processes. Returns a list of (image, crs, transform) tuples in the same
+    order as filepaths. Images are decoded by the workers straight into shared memory so they are never pickled back to
+    the parent. max_in_flight limits how many images are being decoded at once, defaults to no limit."""
+    loaded = {}
+    for index, result in _parallelLoadGeoTiffs(list(enumerate(filepaths)), processes, max_in_flight or len(filepaths)):
+        loaded[index] = result
+    return [loaded[i] for i in range(len(filepaths))]
+
+def iterLoadGeoTiffs(filepaths, processes=multiprocessing.cpu_count(), max_in_flight:int=None):
+    """Load a list of filenames in parallel with N processes. Yields (map_name, (image, crs, transform)) tuples as each
+    image finishes loading. At most max_in_flight images are decoded at once, defaults to twice the number of processes,
+    so memory stays bounded as long as the caller releases images it is done with."""
+    keyed_filepaths = [(os.path.basename(os.path.splitext(filepath)[0]), filepath) for filepath in filepaths]
+    yield from _parallelLoadGeoTiffs(keyed_filepaths, processes, max_in_flight or 2*processes)
+
+class _SharedImage(np.ndarray):
+    """An image backed by a shared memory block. Holds the block so it stays mapped for as long as the image or any view of it exists."""
+    pass
 
-    return images
+def _parallelLoadGeoTiffs(keyed_filepaths, processes, max_in_flight):
+    pending = iter(keyed_filepaths)
+    in_flight = {}
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        try:
+            while True:
+                # Top up the in flight loads
+                while len(in_flight) < max_in_flight:
+                    key, filepath = next(pending, (None, None))
+                    if filepath is None:
+                        break
+                    with rasterio.open(filepath) as fh:
+                        shape = (fh.count, fh.height, fh.width)
+                        dtype = np.dtype(fh.dtypes[0])
+                    shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape))*dtype.itemsize, 1))
+                    future = executor.submit(_loadGeoTiffShared, filepath, shm.name, shape, dtype)
+                    in_flight[future] = (key, shm, shape, dtype)
+                if len(in_flight) == 0:
+                    break
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    key, shm, shape, dtype = in_flight.pop(future)
+                    try:
+                        crs, transform = future.result()
+                    except Exception:
+                        shm.close()
+                        shm.unlink()
+                        raise
+                    image = np.ndarray(shape, dtype=dtype, buffer=shm.buf).view(_SharedImage)
+                    image._shm = shm
+                    # The block is released once the last view of the image is gone
+                    shm.unlink()
+                    yield key, (image, crs, Affine(*transform))
+        finally:
+            for future, (_, shm, _, _) in in_flight.items():
+                future.cancel()
+                shm.close()
+                shm.unlink()
+
+def _loadGeoTiffShared(filepath:Path, shm_name:str, shape:tuple, dtype:np.dtype):
+    """Worker process side of _parallelLoadGeoTiffs. Decodes the image into the named shared memory block. Returns the crs and transform coefficients"""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        image = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        with rasterio.open(filepath) as fh:
+            fh.read(out=image)
+            crs = fh.crs
+            # Send the coefficients rather than the Affine, not every version of affine can be pickled
+            transform = (fh.transform.a, fh.transform.b, fh.transform.c, fh.transform.d, fh.transform.e, fh.transform.f)
+        del image
+    finally:
+        shm.close()
+    return crs, transform
 # endregion GeoTiff
 
 # region CMAAS Map IO
-def loadCMAASMapFromFiles(image_path:Path, legend_path:Path=None, layout_path:Path=None, georef_path:Path=None, metadata_path:Path=None) -> CMAAS_Map:
-    """Loads a CMAAS Map from its individual file components. Returns a CMAAS_Map object."""
+def loadCMAASMapFromFiles(image_path:Path, legend_path:Path=None, layout_path:Path=None, georef_path:Path=None, metadata_path:Path=None, lazy_image:bool=False) -> CMAAS_Map:
+    """Loads a CMAAS Map from its individual file components. Returns a CMAAS_Map object. If lazy_image is set the image
+    is a LazyGeoTiff handle that reads pixels on demand instead of the full image."""
     map_name = os.path.basename(os.path.splitext(image_path)[0])
 
     # Start Threads
     with ThreadPoolExecutor() as executor:
-        img_future = executor.submit(loadGeoTiff, image_path)
+        img_future = executor.submit(openGeoTiff if lazy_image else loadGeoTiff, image_path)
         if legend_path is not None:
             lgd_future = executor.submit(loadLegendJson, legend_path)
         if layout_path is not None:
             lay_future = executor.submit(loadLayoutJson, layout_path)
         
         image, crs, transform = img_future.result()
+        legend, layout = None, None
         if legend_path is not None:
             legend = lgd_future.result()
         if layout_path is not None:
             layout = lay_future.result()
-        georef = GeoReference(provenance=Provenance(name='GeoTIFF'), crs=crs, transform=transform)
-    
+
+    return _buildCMAASMap(map_name, image, crs, transform, legend, layout)
+
+def _buildCMAASMap(map_name:str, image, crs, transform, legend:Legend=None, layout:Layout=None) -> CMAAS_Map:
+    georef = GeoReference(provenance=Provenance(name='GeoTIFF'), crs=crs, transform=transform)
     map_data = CMAAS_Map(name=map_name, image=image, georef=georef)
-    if legend_path is not None:
+    if legend is not None:
         map_data.legend = legend
-    if layout_path is not None:
+    if layout is not None:
         map_data.layout = layout
-
     return map_data
 
-def saveGeoPackage(filepath: Path, map_data: CMAAS_Map, coord_type:str='pixel'):
-    # Create a GeoDataFrame to store all features
-    gdf = gpd.GeoDataFrame()
-    
+def iterLoadCMAASMapsFromDirectory(image_dir:Path, legend_dir:Path=None, layout_dir:Path=None, threads:int=4, prefetch:int=None, lazy_image:bool=False):
+    """Load every map in a directory of GeoTiffs with a pool of N threads. Legend and layout files are paired with each
+    image by map name ({map_name}.json) when their directories are given. Yields CMAAS_Map objects as each map finishes
+    loading. At most prefetch maps are loaded ahead of the caller, defaults to twice the number of threads, so memory
+    stays bounded no matter how many maps are in the directory."""
+    if prefetch is None:
+        prefetch = 2*threads
+
+    pending = _pairMapFiles(image_dir, legend_dir, layout_dir)
+    in_flight = set()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        try:
+            while True:
+                # Top up the prefetched maps
+                while len(in_flight) < prefetch:
+                    map_files = next(pending, None)
+                    if map_files is None:
+                        break
+                    image_path, legend_path, layout_path = map_files
+                    in_flight.add(executor.submit(loadCMAASMapFromFiles, image_path, legend_path, layout_path, lazy_image=lazy_image))
+                if len(in_flight) == 0:
+                    break
+
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        finally:
+            # Don't start loads that will never be collected if the caller stops early
+            for future in in_flight:
+                future.cancel()
+
+def _pairMapFiles(image_dir:Path, legend_dir:Path=None, layout_dir:Path=None):
+    """Yields (image_path, legend_path, layout_path) for each GeoTiff in image_dir. Legend and layout paths are None if
+    there is no matching file for that map."""
+    for filename in sorted(os.listdir(image_dir)):
+        if os.path.splitext(filename)[1].lower() not in ['.tif', '.tiff']:
+            continue
+        map_name = os.path.splitext(filename)[0]
+        legend_path = None
+        if legend_dir is not None and os.path.exists(os.path.join(legend_dir, f'{map_name}.json')):
+            legend_path = os.path.join(legend_dir, f'{map_name}.json')
+        layout_path = None
+        if layout_dir is not None and os.path.exists(os.path.join(layout_dir, f'{map_name}.json')):
+            layout_path = os.path.join(layout_dir, f'{map_name}.json')
+        yield os.path.join(image_dir, filename), legend_path, layout_path
+
+def saveGeoPackage(filepath: Path, map_data: CMAAS_Map, coord_type:str='pixel', single_layer:bool=False):
+    """Save the segmentation geometry of a map to a GeoPackage. Each map unit is saved as a layer named after its label,
+    map units without a label are saved to a layer named after the file. If single_layer is set all map units are
+    instead saved to one layer named after the map with label and type columns. single_layer is the fast path for maps
+    with many map units, it writes the file once while the per unit layers reopen the file for every layer. coord_type
+    can be 'pixel' or 'georef', georef applies the transform of the map to the geometry."""
     # Get the crs
     if map_data.georef and map_data.georef.crs:
         crs = map_data.georef.crs
     else:
         crs = CRS.from_epsg(4326)
 
-    # Process each feature in the legend
+    # Gather the geometry of every feature in the legend
+    labels, types, geometries = [], [], []
     for feature in map_data.legend.features:
-        if feature.segmentation and feature.segmentation.geometry:
-            geometries = feature.segmentation.geometry
-            
-            # Apply transform
-            if map_data.georef and map_data.georef.transform and coord_type == 'georef':
-                transform = map_data.georef.transform
-                affine_params = [transform.a, transform.b, transform.d, transform.e, transform.xoff, transform.yoff]
-                geometries = [affine_transform(geom, affine_params) for geom in geometries]
-            
-            # Create a GeoDataFrame for this feature    
-            gdf = gpd.GeoDataFrame(geometry=geometries, crs=crs)
-
-            # Save to GeoPackage
-            gdf.to_file(filepath, layer=feature.label, driver="GPKG")
+        if feature.segmentation is not None and feature.segmentation.geometry is not None and len(feature.segmentation.geometry) > 0:
+            unit_geometry = feature.segmentation.geometry_array()
+            labels.extend([feature.label] * len(unit_geometry))
+            types.extend([feature.type.to_str()] * len(unit_geometry))
+            geometries.append(unit_geometry)
+    if len(geometries) == 0:
+        return
+    geometries = np.concatenate(geometries)
+
+    # Apply transform to all geometries at once
+    if map_data.georef and map_data.georef.transform and coord_type == 'georef':
+        geometries = affine_transform_geometry(geometries, map_data.georef.transform)
+
+    gdf = gpd.GeoDataFrame({'label' : labels, 'type' : types}, geometry=geometries, crs=crs)
+    if single_layer:
+        gdf.to_file(filepath, layer=map_data.name, driver='GPKG')
+    else:
+        unlabeled_layer = os.path.splitext(os.path.basename(filepath))[0]
+        for label, layer_gdf in gdf.groupby('label', sort=False, dropna=False):
+            # Missing labels are grouped under NaN
+            layer = label if isinstance(label, str) else unlabeled_layer
+            layer_gdf[['geometry']].to_file(filepath, layer=layer, driver='GPKG')
     
 # Deprecating
 # def parallelLoadCMASSMapFromFiles(map_files, legend_path=None, layout_path=None, processes : int=multiprocessing.cpu_count()):
@@ -245,22 +582,280 @@ def saveGeoPackage(filepath: Path, map_data: CMAAS_Map, coord_type:str='pixel'):
 #     return results
 # endregion CMAAS Map IO
 
+# region CMAAS Map Bundle
+def saveCMAASMapBundle(dirpath:Path, map_data:CMAAS_Map):
+    """
+    Save a CMAAS_Map, including its image, segmentations, legend geometry, layout, georef and metadata, to a bundle
+    directory that loadCMAASMapBundle can reopen without rerunning any loaders. Arrays are saved as .npy files so they
+    can be memory mapped when loaded, geometry as WKB and everything else as json. A LazyGeoTiff image is saved as a
+    reference to its GeoTiff and compact arrays are saved decoded.
+
+    Args:
+        dirpath (Path): The directory to save the bundle to. Created if it doesn't exist.
+        map_data (CMAAS_Map): The map to save.
+    """
+    os.makedirs(os.path.join(dirpath, 'arrays'), exist_ok=True)
+    geometries, array_paths = [], []
+    bundle = {'version' : _BUNDLE_VERSION, 'map' : _encodeBundleValue(map_data, dirpath, geometries, array_paths)}
+
+    wkb = shapely.to_wkb(np.array(geometries, dtype=object)) if len(geometries) > 0 else []
+    offsets = np.concatenate([[0], np.cumsum([len(g) for g in wkb], dtype=np.int64)]).astype(np.int64)
+    with open(os.path.join(dirpath, 'geometry.wkb'), 'wb') as fh:
+        fh.write(b''.join(wkb))
+    np.save(os.path.join(dirpath, 'geometry_offsets.npy'), offsets)
+    with open(os.path.join(dirpath, 'map.json'), 'w') as fh:
+        fh.write(_jsonDumps(bundle))
+
+def loadCMAASMapBundle(dirpath:Path, mmap:bool=True) -> CMAAS_Map:
+    """
+    Load a CMAAS_Map from a bundle directory saved by saveCMAASMapBundle.
+
+    Args:
+        dirpath (Path): The bundle directory.
+        mmap (bool, optional): Memory map the arrays read only instead of reading them into memory. Defaults to True.
+
+    Returns:
+        CMAAS_Map: The loaded map.
+    """
+    bundle = _loadJsonFile(os.path.join(dirpath, 'map.json'))
+    if bundle['version'] != _BUNDLE_VERSION:
+        msg = f'Unsupported CMAAS map bundle version "{bundle["version"]}" in "{dirpath}", expected "{_BUNDLE_VERSION}"'
+        raise ValueError(msg)
+    with open(os.path.join(dirpath, 'geometry.wkb'), 'rb') as fh:
+        wkb = fh.read()
+    offsets = np.load(os.path.join(dirpath, 'geometry_offsets.npy')).tolist()
+    geometries = shapely.from_wkb(np.array([wkb[offsets[i]:offsets[i+1]] for i in range(len(offsets)-1)], dtype=object)) if len(offsets) > 1 else []
+    return CMAAS_Map.model_validate(_decodeBundleValue(bundle['map'], dirpath, geometries, mmap))
+
+_BUNDLE_VERSION = '0.1'
+
+def _encodeBundleValue(value, dirpath:Path, geometries:list, array_paths:list):
+    """Converts a value to json compatible data, saving arrays to the bundle and adding geometry to geometries."""
+    if isinstance(value, BaseModel):
+        return {name : _encodeBundleValue(getattr(value, name), dirpath, geometries, array_paths) for name in type(value).model_fields}
+    if isinstance(value, np.ndarray) and value.dtype == object:
+        # Geometry arrays are stored as one range of the geometry file
+        geometries.extend(value.tolist())
+        return {'__wkb_array__' : [len(geometries) - len(value), len(geometries)]}
+    if isinstance(value, (np.ndarray, RLEArray, SparseMask)):
+        array_path = os.path.join('arrays', f'{len(array_paths)}.npy')
+        np.save(os.path.join(dirpath, array_path), np.asarray(value))
+        array_paths.append(array_path)
+        return {'__npy__' : array_path}
+    if isinstance(value, LazyGeoTiff):
+        return {'__geotiff__' : os.path.abspath(value.filepath)}
+    if isinstance(value, CRS):
+        return {'__crs__' : value.to_wkt()}
+    if isinstance(value, Affine):
+        return {'__affine__' : [value.a, value.b, value.c, value.d, value.e, value.f]}
+    if isinstance(value, shapely.Geometry):
+        geometries.append(value)
+        return {'__wkb__' : len(geometries) - 1}
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (list, tuple)):
+        if len(value) > 0 and all(isinstance(v, shapely.Geometry) for v in value):
+            # Store lists of geometry as one range of the geometry file
+            geometries.extend(value)
+            return {'__wkb_list__' : [len(geometries) - len(value), len(geometries)]}
+        return [_encodeBundleValue(v, dirpath, geometries, array_paths) for v in value]
+    if isinstance(value, dict):
+        return {k : _encodeBundleValue(v, dirpath, geometries, array_paths) for k, v in value.items()}
+    return value
+
+def _decodeBundleValue(value, dirpath:Path, geometries, mmap:bool):
+    """Reverses _encodeBundleValue, the result is ready to be validated as a CMAAS_Map."""
+    if isinstance(value, list):
+        return [_decodeBundleValue(v, dirpath, geometries, mmap) for v in value]
+    if not isinstance(value, dict):
+        return value
+    if '__npy__' in value:
+        return np.load(os.path.join(dirpath, value['__npy__']), mmap_mode='r' if mmap else None)
+    if '__geotiff__' in value:
+        return LazyGeoTiff(value['__geotiff__'])
+    if '__crs__' in value:
+        return CRS.from_wkt(value['__crs__'])
+    if '__affine__' in value:
+        return Affine(*value['__affine__'])
+    if '__wkb__' in value:
+        return geometries[value['__wkb__']]
+    if '__wkb_list__' in value:
+        return list(geometries[slice(*value['__wkb_list__'])])
+    if '__wkb_array__' in value:
+        return np.array(geometries[slice(*value['__wkb_array__'])], dtype=object)
+    return {k : _decodeBundleValue(v, dirpath, geometries, mmap) for k, v in value.items()}
+# endregion CMAAS Map Bundle
+
+# region Async IO
+_async_executor = None
+_async_executor_owned = False
+_async_executor_lock = threading.Lock()
+
+def setAsyncExecutor(executor:Executor=None, threads:int=None):
+    """Set the executor that the async load functions run on. Pass an existing executor to share it with the rest of an
+    application, or a number of threads to create a new thread pool. The previous executor is shut down if it was
+    created by this module."""
+    global _async_executor, _async_executor_owned
+    owned = executor is None
+    if owned:
+        executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='cmaas_utils_io')
+    with _async_executor_lock:
+        previous, previous_owned = _async_executor, _async_executor_owned
+        _async_executor, _async_executor_owned = executor, owned
+    if previous is not None and previous_owned:
+        previous.shutdown(wait=False)
+
+def getAsyncExecutor() -> Executor:
+    """Returns the executor that the async load functions run on, creating a default thread pool on first use."""
+    global _async_executor, _async_executor_owned
+    with _async_executor_lock:
+        if _async_executor is None:
+            _async_executor = ThreadPoolExecutor(thread_name_prefix='cmaas_utils_io')
+            _async_executor_owned = True
+        return _async_executor
+
+async def _runAsync(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(getAsyncExecutor(), functools.partial(func, *args, **kwargs))
+
+async def loadLegendJsonAsync(filepath:Path, type_filter:MapUnitType=MapUnitType.ALL()) -> Legend:
+    """Async version of loadLegendJson. Runs on the shared async executor."""
+    return await _runAsync(loadLegendJson, filepath, type_filter)
+
+async def loadLayoutJsonAsync(filepath:Path) -> Layout:
+    """Async version of loadLayoutJson. Runs on the shared async executor."""
+    return await _runAsync(loadLayoutJson, filepath)
+
+async def loadGeoTiffAsync(filepath:Path, cache:RasterCache=None):
+    """Async version of loadGeoTiff. Runs on the shared async executor. Returns a tuple of the image, crs and transform."""
+    return await _runAsync(loadGeoTiff, filepath, cache)
+
+async def loadCMAASMapFromFilesAsync(image_path:Path, legend_path:Path=None, layout_path:Path=None, georef_path:Path=None, metadata_path:Path=None, lazy_image:bool=False) -> CMAAS_Map:
+    """Async version of loadCMAASMapFromFiles. The image, legend and layout are loaded concurrently on the shared async
+    executor instead of a new thread pool per call. Returns a CMAAS_Map object."""
+    map_name = os.path.basename(os.path.splitext(image_path)[0])
+    loads = [_runAsync(openGeoTiff if lazy_image else loadGeoTiff, image_path)]
+    if legend_path is not None:
+        loads.append(loadLegendJsonAsync(legend_path))
+    if layout_path is not None:
+        loads.append(loadLayoutJsonAsync(layout_path))
+    results = await asyncio.gather(*loads)
+
+    image, crs, transform = results.pop(0)
+    legend = results.pop(0) if legend_path is not None else None
+    layout = results.pop(0) if layout_path is not None else None
+    return _buildCMAASMap(map_name, image, crs, transform, legend, layout)
+
+async def loadCMAASMapsAsync(map_files, max_concurrency:int=8, lazy_image:bool=False):
+    """Load many maps concurrently with at most max_concurrency maps loading at once. map_files is a list of
+    (image_path, legend_path, layout_path) tuples, legend and layout paths may be None. Returns a list of CMAAS_Map
+    objects in the same order as map_files."""
+    semaphore = asyncio.Semaphore(max_concurrency)
+    async def _load(image_path, legend_path=None, layout_path=None):
+        async with semaphore:
+            return await loadCMAASMapFromFilesAsync(image_path, legend_path, layout_path, lazy_image=lazy_image)
+    return await asyncio.gather(*[_load(*files) for files in map_files])
+# endregion Async IO
+
 # region CDR IO
 def loadCDRMapResults(filepath:Path) -> MapResults:
     """Load a CDR Map Result from a json file. Returns a MapResults object."""
-    with open(filepath, 'r') as fh:
-        json_data = json.load(fh)
+    json_data = _loadJsonFile(filepath)
     return parse_obj_as(MapResults, json_data)
     
 def loadCDRFeatureResults(filepath:Path) -> FeatureResults:
     """Load a CDR Feature Result from a json file. Returns a FeatureResults object."""
-    with open(filepath, 'r') as fh:
-        json_data = json.load(fh)
+    json_data = _loadJsonFile(filepath)
     return parse_obj_as(FeatureResults, json_data)
 
+def iterCDRFeatureResults(filepath:Path):
+    """Incrementally load a CDR Feature Result from a json file. Yields (field_name, value) tuples for each field of the
+    FeatureResults, list fields such as polygon_feature_results yield one tuple per item so only a single
+    PointLegendAndFeaturesResult, LineLegendAndFeaturesResult or PolygonLegendAndFeaturesResult is in memory at a time.
+    The stream can be converted directly with cdr.convert_cdr_feature_results_stream_to_cmaas_map. Requires ijson."""
+    if ijson is None:
+        msg = 'iterCDRFeatureResults requires ijson to be installed'
+        raise ImportError(msg)
+    adapters = {}
+    builder, builder_prefix = None, None
+    with _openFile(filepath, 'rb') as fh:
+        for prefix, event, value in ijson.parse(fh, use_float=True):
+            if builder is not None:
+                builder.event(event, value)
+                if prefix == builder_prefix and event in ['end_map', 'end_array']:
+                    field_name = builder_prefix.split('.')[0]
+                    yield field_name, adapters[field_name].validate_python(builder.value)
+                    builder = None
+                continue
+            if '.' in prefix:
+                field_name, rest = prefix.split('.', 1)
+                if rest == 'item' and event in ['start_map', 'start_array']:
+                    # Start of a list item
+                    if field_name not in adapters:
+                        adapters[field_name] = TypeAdapter(_listItemType(FeatureResults.model_fields[field_name].annotation))
+                    builder, builder_prefix = ijson.ObjectBuilder(), prefix
+                    builder.event(event, value)
+                elif rest == 'item':
+                    # Scalar list item
+                    yield field_name, value
+            elif prefix != '' and event in ['start_map']:
+                # Non list object field
+                if prefix not in adapters:
+                    adapters[prefix] = TypeAdapter(FeatureResults.model_fields[prefix].annotation)
+                builder, builder_prefix = ijson.ObjectBuilder(), prefix
+                builder.event(event, value)
+            elif prefix != '' and event not in ['start_array', 'end_array', 'map_key']:
+                # Scalar field
+                yield prefix, value
+
+def _listItemType(annotation):
+    """Returns the item type of a List or Optional[List] annotation."""
+    if get_origin(annotation) is Union:
+        annotation = next(arg for arg in get_args(annotation) if arg is not type(None))
+    return get_args(annotation)[0]
+
+# Fields of a FeatureResults that are written one item at a time by saveCDRFeatureResults
+_CDR_FEATURE_RESULTS_STREAM = {
+    'point_feature_results' : {'point_features' : {'features' : None}},
+    'line_feature_results' : {'line_features' : {'features' : None}},
+    'polygon_feature_results' : {'polygon_features' : {'features' : None}},
+}
+
 def saveCDRFeatureResults(filepath, feature_result: FeatureResults):
-    """Save a CDR Feature Result to a json file."""
-    # Save CDR schema
-    with open(filepath, 'w') as fh:
-        fh.write(feature_result.model_dump_json())
+    """Save a CDR Feature Result to a json file. The result is written one feature at a time so peak memory is bounded by
+    the largest single feature instead of the whole document. The output is identical to feature_result.model_dump_json().
+    The file is gzip compressed if filepath ends in .gz"""
+    with _openFile(filepath, 'w') as fh:
+        _writeModelJson(fh, feature_result, _CDR_FEATURE_RESULTS_STREAM)
+
+def _writeModelJson(fh, model:BaseModel, stream:dict=None):
+    """Write model as json to fh. stream maps the names of fields to write item by item to the stream for their items,
+    a stream of None writes each item whole. All other fields are serialized whole."""
+    if not stream:
+        fh.write(model.model_dump_json())
+        return
+    fh.write('{')
+    first = True
+    for name, field in type(model).model_fields.items():
+        if field.exclude:
+            continue
+        if not first:
+            fh.write(',')
+        first = False
+        fh.write(f'{json.dumps(name)}:')
+        value = getattr(model, name)
+        if name not in stream or value is None:
+            fh.write(to_json(value, inf_nan_mode='null').decode())
+        elif isinstance(value, list):
+            fh.write('[')
+            for i, item in enumerate(value):
+                if i > 0:
+                    fh.write(',')
+                _writeModelJson(fh, item, stream[name])
+            fh.write(']')
+        else:
+            _writeModelJson(fh, value, stream[name])
+    fh.write('}')
 # endregion CDR IO
\ No newline at end of file
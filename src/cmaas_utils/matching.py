@@ -0,0 +1,100 @@
+import numpy as np
+from typing import List, Optional, Tuple
+
+from .types import Legend, MapUnit, MapUnitType, _normalize_name
+
+def _ngrams(name:str, n:int) -> set:
+    """The set of character n-grams of a normalized name, padded so short names and word edges still produce n-grams."""
+    padded = f' {name} '
+    if len(padded) <= n:
+        return {padded}
+    return {padded[i:i+n] for i in range(len(padded) - n + 1)}
+
+class LegendMatcher():
+    """
+    Fuzzy matches names against the labels, abbreviations and aliases of the map units in a reference legend. The
+    n-grams of every normalized name in the legend are indexed once when the matcher is created, each query then only
+    scores the names that share an n-gram with it. Scores are the Dice coefficient of the n-gram sets, 1.0 for an exact
+    match, and a map unit's score is the best score of any of its names.
+
+    Args:
+        legend (Legend): The reference legend to match against.
+        n (int, optional): The length of the character n-grams. Defaults to 3.
+    """
+    def __init__(self, legend:Legend, n:int=3):
+        self.legend = legend
+        self.n = n
+        self.units = list(legend.features)
+        self.unit_types = [map_unit.type for map_unit in self.units]
+
+        name_units, name_sizes, postings = [], [], {}
+        for unit_index, map_unit in enumerate(self.units):
+            names = [map_unit.label, map_unit.abbreviation, *(map_unit.aliases or [])]
+            for name in set(_normalize_name(name) for name in names if name):
+                grams = _ngrams(name, n)
+                for gram in grams:
+                    postings.setdefault(gram, []).append(len(name_units))
+                name_units.append(unit_index)
+                name_sizes.append(len(grams))
+        self._name_units = np.array(name_units, dtype=np.int64)
+        self._name_sizes = np.array(name_sizes, dtype=np.float64)
+        self._postings = {gram : np.array(names, dtype=np.int64) for gram, names in postings.items()}
+
+    def scores(self, name:str) -> np.ndarray:
+        """Returns the score of name against every map unit in the legend, in legend order."""
+        grams = _ngrams(_normalize_name(name), self.n)
+        unit_scores = np.zeros(len(self.units), dtype=np.float64)
+        matched = [self._postings[gram] for gram in grams if gram in self._postings]
+        if len(matched) == 0:
+            return unit_scores
+        shared = np.bincount(np.concatenate(matched), minlength=len(self._name_units))
+        name_scores = 2 * shared / (len(grams) + self._name_sizes)
+        np.maximum.at(unit_scores, self._name_units, name_scores)
+        return unit_scores
+
+    def match(self, names:List[str], top_k:int=1, min_score:float=0.0, unit_types:Optional[List[MapUnitType]]=None) -> List[List[Tuple[MapUnit, float]]]:
+        """
+        Match a batch of names against the legend.
+
+        Args:
+            names (List[str]): The names to match.
+            top_k (int, optional): The number of matches to return for each name. Defaults to 1.
+            min_score (float, optional): Matches scoring below this are dropped. Defaults to 0.0.
+            unit_types (List[MapUnitType], optional): The type of map unit each name is for. Names are then only
+                matched against map units of the same type, UNKNOWN matches any type. Defaults to None.
+
+        Returns:
+            List[List[Tuple[MapUnit, float]]]: The (map unit, score) matches for each name, best first.
+        """
+        unit_types_array = np.array([t.value for t in self.unit_types], dtype=np.int64)
+        results = []
+        for i, name in enumerate(names):
+            unit_scores = self.scores(name)
+            if unit_types is not None and unit_types[i] != MapUnitType.UNKNOWN:
+                unit_scores[unit_types_array != unit_types[i].value] = 0
+            best = np.argsort(-unit_scores, kind='stable')[:top_k]
+            results.append([(self.units[j], float(unit_scores[j])) for j in best if unit_scores[j] > 0 and unit_scores[j] >= min_score])
+        return results
+
+    def match_legend(self, legend:Legend, min_score:float=0.0, match_type:bool=True) -> List[Tuple[MapUnit, Optional[MapUnit], float]]:
+        """
+        Match the label of every map unit in a legend, such as a predicted legend, against the reference legend.
+
+        Args:
+            legend (Legend): The legend to match.
+            min_score (float, optional): Matches scoring below this are treated as unmatched. Defaults to 0.0.
+            match_type (bool, optional): Only match map units of the same type. Defaults to True.
+
+        Returns:
+            List[Tuple[MapUnit, Optional[MapUnit], float]]: (map unit, best reference map unit, score) for each map
+                unit in the legend. The reference map unit is None and the score 0.0 if there was no match.
+        """
+        names = [map_unit.label or '' for map_unit in legend.features]
+        unit_types = [map_unit.type for map_unit in legend.features] if match_type else None
+        results = []
+        for map_unit, matches in zip(legend.features, self.match(names, 1, min_score, unit_types)):
+            if len(matches) > 0:
+                results.append((map_unit, *matches[0]))
+            else:
+                results.append((map_unit, None, 0.0))
+        return results
@@ -1,11 +1,33 @@
 import rasterio
+import rasterio.windows
 import numpy as np
+import shapely
 from enum import Enum
 from typing import List, Optional, Union
 from shapely.geometry import Polygon
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr, field_validator
 from rasterio.crs import CRS
 
+def construct_model(model_type, trusted:bool=False, **kwargs):
+    """
+    Construct a pydantic model, such as any of the types in this module or a cdr_schemas type. If trusted is set
+    pydantic validation is skipped with model_construct, which avoids walking every coordinate of models holding
+    geometry such as AreaBoundary. Nothing is coerced or copied for trusted data, so each value must already be exactly
+    the type of its field, e.g. a MapUnitType rather than a str and a list of floats rather than a numpy array. Only
+    use it for data that has already been validated, such as the fields of a parsed cdr_schemas object.
+
+    Args:
+        model_type (type): The pydantic model to construct.
+        trusted (bool, optional): Skip validation of the data. Defaults to False.
+        **kwargs: The fields of the model. Fields that are not given are set to their defaults.
+
+    Returns:
+        BaseModel: An instance of model_type.
+    """
+    if trusted:
+        return model_type.model_construct(**kwargs)
+    return model_type(**kwargs)
+
 class Provenance(BaseModel):
     name : str = Field(    
         description='The name of the model used to generate the data')
@@ -13,6 +35,221 @@ class Provenance(BaseModel):
         default=None,
         description='The version of the model used to generate the data')
 
+# region Compact Arrays
+def minimal_dtype(image:np.ndarray) -> np.dtype:
+    """Returns the smallest integer dtype that can hold every value of an integer image, E.g. uint8 for a label image of
+    a legend with fewer than 256 map units."""
+    if image.size == 0:
+        return np.dtype(np.uint8)
+    return np.result_type(np.min_scalar_type(image.min()), np.min_scalar_type(image.max()))
+
+def _index_rows(key, num_rows:int):
+    """Splits an index into the rows of the first axis it needs and the index to apply to those rows. Returns None for
+    the rows if the whole array is needed."""
+    if not isinstance(key, tuple):
+        key = (key,)
+    if len(key) == 0 or key[0] is Ellipsis:
+        return None, key
+    if isinstance(key[0], slice):
+        start, stop, step = key[0].indices(num_rows)
+        if step > 0:
+            return (start, max(start, stop)), (slice(None, None, step), *key[1:])
+    elif isinstance(key[0], (int, np.integer)):
+        k = int(key[0]) + num_rows if key[0] < 0 else int(key[0])
+        if not 0 <= k < num_rows:
+            raise IndexError(f'index {key[0]} is out of bounds for axis 0 with size {num_rows}')
+        return (k, k+1), (0, *key[1:])
+    return None, key
+
+class RLEArray():
+    """
+    A run length encoded integer array, such as a MapSegmentation image, that decodes to a dense array on access. Each
+    row is encoded separately so indexing it like the original array, E.g. image[100:200, 300:400], only decodes the
+    requested rows. Values are stored in the smallest dtype that fits them, which is also the dtype of decoded arrays.
+    read() decodes the full array.
+    """
+    def __init__(self, image:np.ndarray):
+        image = np.asarray(image)
+        if not np.issubdtype(image.dtype, np.integer) and image.dtype != bool:
+            raise ValueError(f'RLEArray can only encode integer arrays, got {image.dtype}')
+        if image.ndim == 0:
+            raise ValueError('RLEArray can not encode a 0 dimensional array')
+        self.shape = image.shape
+        self.dtype = np.dtype(bool) if image.dtype == bool else minimal_dtype(image)
+        flat = image.reshape(-1)
+        self._row_size = int(np.prod(self.shape[1:], dtype=np.int64))
+        # Runs start where the value changes and at the start of every row
+        starts = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+        starts = np.union1d(starts, np.arange(self.shape[0], dtype=np.int64) * self._row_size)
+        starts = starts[starts < flat.size]
+        self._starts = starts.astype(np.uint32 if flat.size < 2**32 else np.uint64)
+        self._values = flat[starts].astype(self.dtype)
+        self._row_runs = np.searchsorted(starts, np.arange(self.shape[0]+1, dtype=np.int64) * self._row_size)
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    @property
+    def size(self) -> int:
+        return int(np.prod(self.shape, dtype=np.int64))
+
+    @property
+    def nbytes(self) -> int:
+        """The number of bytes used by the encoded array."""
+        return self._starts.nbytes + self._values.nbytes + self._row_runs.nbytes
+
+    def max(self):
+        return self._values.max()
+
+    def min(self):
+        return self._values.min()
+
+    def read(self) -> np.ndarray:
+        """Decodes the full array."""
+        return self._decode_rows(0, self.shape[0])
+
+    def _decode_rows(self, start:int, stop:int) -> np.ndarray:
+        a, b = self._row_runs[start], self._row_runs[stop]
+        ends = np.append(self._starts[a+1:b].astype(np.int64), stop * self._row_size)[:b-a]
+        lengths = ends - self._starts[a:b].astype(np.int64)
+        return np.repeat(self._values[a:b], lengths).reshape(stop - start, *self.shape[1:])
+
+    def __getitem__(self, key) -> np.ndarray:
+        rows, key = _index_rows(key, self.shape[0])
+        if rows is None:
+            return self.read()[key]
+        return self._decode_rows(*rows)[key]
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        image = self.read()
+        return image if dtype is None else image.astype(dtype)
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __str__(self) -> str:
+        return f'RLEArray{{shape : {self.shape}, runs : {len(self._values)}}}'
+
+    def __repr__(self) -> str:
+        return f'RLEArray{{shape : {self.shape}, dtype : {self.dtype}, runs : {len(self._values)}}}'
+
+class SparseMask():
+    """
+    A compact binary mask, such as a MapUnitSegmentation mask, that decodes to a dense array on access. Only the bounding
+    box of the set pixels is stored, packed to one bit per pixel. Indexing it like the original array, E.g.
+    mask[100:200, 300:400], decodes the requested rows. read() decodes the full mask.
+    """
+    def __init__(self, mask:np.ndarray):
+        mask = np.asarray(mask)
+        values = np.unique(mask[mask != 0])
+        if len(values) > 1:
+            raise ValueError(f'SparseMask can only encode binary masks, got {len(values)} non zero values')
+        self.shape = mask.shape
+        self.dtype = mask.dtype
+        self._value = values[0] if len(values) > 0 else np.ones((), dtype=mask.dtype)
+        nonzero = np.nonzero(mask)
+        if len(nonzero[0]) > 0:
+            self._bounds = tuple((int(axis.min()), int(axis.max()) + 1) for axis in nonzero)
+        else:
+            self._bounds = tuple((0, 0) for _ in self.shape)
+        crop = mask[tuple(slice(*b) for b in self._bounds)] != 0
+        self._crop_shape = crop.shape
+        self._bits = np.packbits(crop, axis=None)
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    @property
+    def size(self) -> int:
+        return int(np.prod(self.shape, dtype=np.int64))
+
+    @property
+    def nbytes(self) -> int:
+        """The number of bytes used by the encoded mask."""
+        return self._bits.nbytes
+
+    def read(self) -> np.ndarray:
+        """Decodes the full mask."""
+        return self._decode_rows(0, self.shape[0])
+
+    def _decode_rows(self, start:int, stop:int) -> np.ndarray:
+        mask = np.zeros((stop - start, *self.shape[1:]), dtype=self.dtype)
+        (y0, y1), rest = self._bounds[0], self._bounds[1:]
+        r0, r1 = max(start, y0), min(stop, y1)
+        if r0 < r1:
+            # Unpack only the bits of the requested rows of the crop
+            crop_row = int(np.prod(self._crop_shape[1:], dtype=np.int64))
+            bit_start, bit_stop = (r0 - y0) * crop_row, (r1 - y0) * crop_row
+            bits = np.unpackbits(self._bits[bit_start // 8:-(-bit_stop // 8)])
+            crop = bits[bit_start % 8:bit_start % 8 + bit_stop - bit_start].reshape(r1 - r0, *self._crop_shape[1:])
+            mask[(slice(r0 - start, r1 - start), *(slice(*b) for b in rest))] = crop * self._value
+        return mask
+
+    def __getitem__(self, key) -> np.ndarray:
+        rows, key = _index_rows(key, self.shape[0])
+        if rows is None:
+            return self.read()[key]
+        return self._decode_rows(*rows)[key]
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        mask = self.read()
+        return mask if dtype is None else mask.astype(dtype)
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __str__(self) -> str:
+        return f'SparseMask{{shape : {self.shape}}}'
+
+    def __repr__(self) -> str:
+        return f'SparseMask{{shape : {self.shape}, dtype : {self.dtype}, bounds : {self._bounds}}}'
+
+def _compact_array(array, encoding:str):
+    """Returns array stored with the encoding. 'dtype' keeps a dense array in the smallest integer dtype that fits it,
+    'rle' is a RLEArray and 'sparse' a SparseMask."""
+    if isinstance(array, (RLEArray, SparseMask)):
+        array = array.read()
+    if encoding == 'dtype':
+        return array.astype(minimal_dtype(array), copy=False) if np.issubdtype(array.dtype, np.integer) else array
+    elif encoding == 'rle':
+        return RLEArray(array)
+    elif encoding == 'sparse':
+        return SparseMask(array)
+    raise ValueError(f'Unknown encoding "{encoding}", expected one of \'dtype\', \'rle\' or \'sparse\'')
+# endregion Compact Arrays
+
+# region Geometry
+def as_geometry_array(geometry) -> np.ndarray:
+    """Returns geometry, a list or array of shapely geometries, as a shapely 2 array of geometries. No copy is made if
+    it is already an array."""
+    if geometry is None:
+        return np.empty(0, dtype=object)
+    if isinstance(geometry, np.ndarray):
+        return geometry
+    return np.array(geometry, dtype=object)
+
+def affine_transform_geometry(geometry, transform:rasterio.transform.Affine) -> np.ndarray:
+    """Applies an affine transform, such as a GeoReference transform, to every coordinate of a list or array of shapely
+    geometries at once. Returns an array of the transformed geometries."""
+    matrix = np.array([[transform.a, transform.d], [transform.b, transform.e]])
+    offset = np.array([transform.xoff, transform.yoff])
+    return shapely.transform(as_geometry_array(geometry), lambda coords: coords @ matrix + offset)
+
+def _geometry_equal(geometry1, geometry2) -> bool:
+    """Compares two lists or arrays of geometry element wise. Shapely geometries are compared with shapely.equals, any
+    other geometry, such as point coordinates, by value."""
+    if len(geometry1) != len(geometry2):
+        return False
+    if len(geometry1) == 0:
+        return True
+    array1, array2 = as_geometry_array(geometry1), as_geometry_array(geometry2)
+    if array1.dtype == object and array2.dtype == object and shapely.is_geometry(array1).all() and shapely.is_geometry(array2).all():
+        return bool(np.all(shapely.equals(array1, array2) | (shapely.is_empty(array1) & shapely.is_empty(array2))))
+    return np.array_equal(np.asarray(geometry1), np.asarray(geometry2))
+# endregion Geometry
+
 # region MapUnit
 class MapUnitType(Enum):
     """
@@ -71,16 +308,82 @@ class MapUnitSegmentation(BaseModel):
     confidence : Optional[float] = Field(
         default=None,
         description='The confidence of the segmentation')
-    mask : Optional[np.ndarray] = Field(
+    mask : Optional[Union[np.ndarray, RLEArray, SparseMask]] = Field(
+        default=None,
+        description='A binary mask of the map unit. Either an array or a compact RLEArray or SparseMask that decodes on access')
+    geometry : Optional[Union[np.ndarray, List[Polygon]]] = Field(
+        default=None,
+        description="""The vector geometry of the map unit. Either a list of shapely geometries or a shapely 2 array of
+                    geometries, which skips per geometry validation and is used directly by the vectorized accessors""")
+    points : Optional[np.ndarray] = Field(
+        default=None,
+        description="""The point detections of the map unit as an array of shape (N,2). Format is expected to be [x,y]
+                    coordinate pairs where the top left is the origin (0,0).""")
+    point_sizes : Optional[np.ndarray] = Field(
         default=None,
-        description='A binary mask of the map unit')
-    geometry : Optional[List[Polygon]] = Field(
+        description='The number of pixels in each of the point detections')
+    point_bboxes : Optional[np.ndarray] = Field(
         default=None,
-        description='The vector geometry of the map unit')
+        description="""The bounding box of each of the point detections as an array of shape (N,4). Format is expected to
+                    be [min_x, min_y, max_x, max_y] where the max is the last pixel inside the box.""")
     
     class Config:
         arbitrary_types_allowed = True
 
+    def geometry_array(self) -> np.ndarray:
+        """Returns the geometry as a shapely 2 array of geometries. No copy is made if it is already stored as an array."""
+        return as_geometry_array(self.geometry)
+
+    def to_geometry_array(self):
+        """Store the geometry as a shapely 2 array of geometries instead of a list."""
+        if self.geometry is not None:
+            self.geometry = as_geometry_array(self.geometry)
+
+    def geometry_area(self) -> np.ndarray:
+        """Returns the area of each geometry."""
+        return shapely.area(self.geometry_array())
+
+    def geometry_bounds(self) -> np.ndarray:
+        """Returns the bounds of each geometry as an array of shape (N,4) in [min_x, min_y, max_x, max_y] format."""
+        return shapely.bounds(self.geometry_array()).reshape(-1, 4)
+
+    def transform_geometry(self, transform:rasterio.transform.Affine) -> np.ndarray:
+        """Returns an array of the geometry with an affine transform, such as a GeoReference transform, applied."""
+        return affine_transform_geometry(self.geometry_array(), transform)
+
+    def geometry_coordinates(self) -> tuple:
+        """Returns the geometry as GeoArrow style coordinate and offset buffers. See shapely.to_ragged_array.
+
+        Returns:
+            shapely.GeometryType: The type of the geometries.
+            np.ndarray: The coordinates of every geometry as an array of shape (N,2).
+            Tuple[np.ndarray]: The offsets into the coordinates of each ring, part and geometry.
+        """
+        return shapely.to_ragged_array(self.geometry_array())
+
+    def __eq__(self, __value) -> bool:
+        if not isinstance(__value, MapUnitSegmentation):
+            return False
+        if self.provenance != __value.provenance or self.confidence != __value.confidence:
+            return False
+        # Array fields are compared by value, including compact masks against dense ones
+        for field in ['mask', 'points', 'point_sizes', 'point_bboxes']:
+            a1, a2 = getattr(self, field), getattr(__value, field)
+            if a1 is None or a2 is None:
+                if a1 is not a2:
+                    return False
+            elif not np.array_equal(np.asarray(a1), np.asarray(a2)):
+                return False
+        if self.geometry is None or __value.geometry is None:
+            return self.geometry is __value.geometry
+        return _geometry_equal(self.geometry, __value.geometry)
+
+    def compact(self, encoding:str='sparse'):
+        """Store the mask compactly. encoding can be 'sparse' for a SparseMask, 'rle' for a RLEArray or 'dtype' for an
+        array in the smallest integer dtype that fits it."""
+        if self.mask is not None:
+            self.mask = _compact_array(self.mask, encoding)
+
 class MapUnit(BaseModel):
     """
     A unit which contains the information a feature from the Legend.
@@ -148,33 +451,112 @@ class MapUnit(BaseModel):
 # endregion MapUnit
 
 # region Legend
+def _normalize_name(name:str) -> str:
+    """Case and whitespace normalized form of a map unit name used for lookups."""
+    return ' '.join(name.casefold().split())
+
+def _map_unit_key(map_unit:MapUnit):
+    """Hashable key that is equal for any two equal map units."""
+    return (map_unit.type, map_unit.label, map_unit.abbreviation)
+
+class _FeatureList(list):
+    """List of the map units of a legend that counts changes made to it, so a stale index is found without a scan."""
+    _version = 0
+
+def _counted(name:str):
+    method = getattr(list, name)
+    def counted(self, *args, **kwargs):
+        self._version += 1
+        return method(self, *args, **kwargs)
+    counted.__name__ = name
+    return counted
+
+for _name in ['__setitem__', '__delitem__', '__iadd__', '__imul__', 'append', 'extend', 'insert', 'pop', 'remove', 'clear', 'sort', 'reverse']:
+    setattr(_FeatureList, _name, _counted(_name))
+
 class Legend(BaseModel):
     """
-    A collection of map units that make up the legend of a map.
+    A collection of map units that make up the legend of a map. Map units can be looked up by label, abbreviation,
+    alias or type through an index that is rebuilt whenever the map units in features change, including units being
+    added, removed or replaced in place. Call invalidate_index after editing the names or type of a map unit.
     """
     provenance : Provenance = Field(
         description='Information about the source the Legend orginated from')
     features : List[MapUnit] = Field(
         default=[],
         description='The map units that make up the legend')
+    _index : Optional[dict] = PrivateAttr(default=None)
+    _index_key : Optional[tuple] = PrivateAttr(default=None)
+
+    @field_validator('features')
+    @classmethod
+    def _count_changes(cls, features):
+        return _FeatureList(features)
+
+    def __setattr__(self, name, value):
+        if name == 'features' and not isinstance(value, _FeatureList):
+            value = _FeatureList(value)
+        super().__setattr__(name, value)
     
     def to_dict(self):
         feature_dict = {}
         for map_unit in self.features:
-            feature_dict[map_unit.label] = map_unit.to_dict()
+            feature_dict[map_unit.label] = map_unit.model_dump()
         return {
             'features' : feature_dict,
-            'provenance' : self.provenance
+            'provenance' : self.provenance.model_dump()
         }
     
     def map_unit_distr(self):
-        dist = {}
-        for feature in self.features:
-            if feature.type in dist:
-                dist[feature.type].append(feature.label)
-            else:
-                dist[feature.type] = [feature.label]
-        return dist
+        return {unit_type : [map_unit.label for map_unit in map_units] for unit_type, map_units in self._get_index()['type'].items()}
+
+    def get_by_label(self, label:str) -> List[MapUnit]:
+        """Returns the map units with the label, ignoring case and whitespace."""
+        return list(self._get_index()['label'].get(_normalize_name(label), []))
+
+    def get_by_abbreviation(self, abbreviation:str) -> List[MapUnit]:
+        """Returns the map units with the abbreviation, ignoring case and whitespace."""
+        return list(self._get_index()['abbreviation'].get(_normalize_name(abbreviation), []))
+
+    def get_by_alias(self, alias:str) -> List[MapUnit]:
+        """Returns the map units with the alias, ignoring case and whitespace."""
+        return list(self._get_index()['alias'].get(_normalize_name(alias), []))
+
+    def get_by_type(self, unit_type:MapUnitType) -> List[MapUnit]:
+        """Returns the map units of the type."""
+        return list(self._get_index()['type'].get(unit_type, []))
+
+    def find(self, name:str) -> List[MapUnit]:
+        """Returns the map units whose label, abbreviation or any alias is name, ignoring case and whitespace. Units are
+        in legend order."""
+        index = self._get_index()
+        name = _normalize_name(name)
+        matches = {id(map_unit) : map_unit for field in ['label', 'abbreviation', 'alias'] for map_unit in index[field].get(name, [])}
+        return [map_unit for map_unit in self.features if id(map_unit) in matches]
+
+    def invalidate_index(self):
+        """Force the lookup index to be rebuilt. Needed after changing the names or type of a map unit."""
+        self._index = None
+
+    def _get_index(self) -> dict:
+        features = self.features
+        if not isinstance(features, _FeatureList):
+            # Built without validation, e.g. with model_construct
+            features = self.__dict__['features'] = _FeatureList(features)
+        # The list itself is kept in the key so its id can't be reused
+        index_key = (features, features._version)
+        if self._index is None or self._index_key[0] is not features or self._index_key[1] != features._version:
+            index = {'label' : {}, 'abbreviation' : {}, 'alias' : {}, 'type' : {}}
+            for map_unit in self.features:
+                if map_unit.label is not None:
+                    index['label'].setdefault(_normalize_name(map_unit.label), []).append(map_unit)
+                if map_unit.abbreviation is not None:
+                    index['abbreviation'].setdefault(_normalize_name(map_unit.abbreviation), []).append(map_unit)
+                for alias in set(_normalize_name(alias) for alias in map_unit.aliases or []):
+                    index['alias'].setdefault(alias, []).append(map_unit)
+                index['type'].setdefault(map_unit.type, []).append(map_unit)
+            self._index, self._index_key = index, index_key
+        return self._index
     
     def __eq__(self, __value) -> bool:
         if self is None or __value is None:
@@ -184,13 +566,19 @@ class Legend(BaseModel):
                 return False
         if self.provenance != __value.provenance:
             return False
+        if len(self.features) != len(__value.features):
+            return False
+        # Multiset comparison, each unit is only compared against the units of the other legend with the same key
+        buckets = {}
+        for u2 in __value.features:
+            buckets.setdefault(_map_unit_key(u2), []).append(u2)
         for u1 in self.features:
-            matched = False
-            for u2 in __value.features:
+            bucket = buckets.get(_map_unit_key(u1), [])
+            for i, u2 in enumerate(bucket):
                 if u1 == u2:
-                    matched = True
+                    del bucket[i]
                     break
-            if not matched:
+            else:
                 return False
         return True
 
@@ -270,13 +658,13 @@ class Layout(BaseModel):
     
     def to_dict(self):
         return {
-            'provenance' : self.provenance,
-            'map' : self.map,
-            'point_legend' : self.point_legend,
-            'line_legend' : self.line_legend,
-            'polygon_legend' : self.polygon_legend,
-            'correlation_diagram' : self.correlation_diagram,
-            'cross_section' : self.cross_section,
+            'provenance' : self.provenance.model_dump(),
+            'map' : [area.model_dump() for area in self.map],
+            'point_legend' : [area.model_dump() for area in self.point_legend],
+            'line_legend' : [area.model_dump() for area in self.line_legend],
+            'polygon_legend' : [area.model_dump() for area in self.polygon_legend],
+            'correlation_diagram' : [area.model_dump() for area in self.correlation_diagram],
+            'cross_section' : [area.model_dump() for area in self.cross_section],
         }
 # endregion Layout
 # region GeoReference
@@ -335,14 +723,12 @@ class CMAAS_MapMetadata(BaseModel):
 
     def to_dict(self):
         return {
-            'provenance' : self.provenance,
+            'provenance' : self.provenance.model_dump(),
             'title' : self.title,
             'authors' : self.authors,
             'year' : self.year,
             'publisher' : self.publisher,
-            'organization' : self.organization,
             'source_url' : self.source_url,
-            'url' : self.url,
             'scale' : self.scale,
             'map_shape' : self.map_shape,
             'map_color' : self.map_color,
@@ -386,6 +772,88 @@ class CMAAS_MapMetadata(BaseModel):
 # endregion Map Metadata
 
 # region CMAAS Map
+class LazyGeoTiff():
+    """
+    A handle to a GeoTiff image that only reads pixels from disk when they are requested. Indexing the handle like a
+    (C,H,W) array, E.g. image[:, 100:200, 300:400], reads just that window of the file. read() loads the full image.
+    """
+    def __init__(self, filepath):
+        self.filepath = filepath
+        with rasterio.open(filepath) as fh:
+            self.shape = (fh.count, fh.height, fh.width)
+            self.dtype = np.dtype(fh.dtypes[0])
+            self.crs = fh.crs
+            self.transform = fh.transform
+
+    @property
+    def ndim(self) -> int:
+        return 3
+
+    def read(self) -> np.ndarray:
+        """Reads the full image. Returns an array in CHW format."""
+        with rasterio.open(self.filepath) as fh:
+            return fh.read()
+
+    def read_window(self, areas) -> tuple:
+        """
+        Reads the bounding box of one or more areas from the image.
+
+        Args:
+            areas (AreaBoundary | List[AreaBoundary]): The area(s) to read.
+
+        Returns:
+            np.array: The window of the image in CHW format.
+            Tuple[int,int]: The x and y offset of the window from the top left of the image.
+        """
+        if isinstance(areas, AreaBoundary):
+            areas = [areas]
+        coords = np.concatenate([np.asarray(ring).reshape(-1,2) for area in areas for ring in area.geometry])
+        x0, y0 = np.maximum(np.floor(coords.min(axis=0)).astype(int), 0)
+        x1, y1 = np.minimum(np.ceil(coords.max(axis=0)).astype(int) + 1, [self.shape[2], self.shape[1]])
+        return self[:, y0:max(y0, y1), x0:max(x0, x1)], (int(x0), int(y0))
+
+    def __getitem__(self, key) -> np.ndarray:
+        if not isinstance(key, tuple):
+            key = (key,)
+        if Ellipsis in key:
+            i = key.index(Ellipsis)
+            key = key[:i] + (slice(None),) * (3 - len(key) + 1) + key[i+1:]
+        key = key + (slice(None),) * (3 - len(key))
+        # Read the smallest window that contains the requested pixels, then index into it
+        window_key = []
+        bounds = []
+        for k, size in zip(key[1:], self.shape[1:]):
+            if isinstance(k, slice) and k.step in (None, 1):
+                start, stop, _ = k.indices(size)
+                stop = max(start, stop)
+                bounds.append((start, stop))
+                window_key.append(slice(None))
+            elif isinstance(k, (int, np.integer)):
+                k = int(k) + size if k < 0 else int(k)
+                if not 0 <= k < size:
+                    raise IndexError(f'index {k} is out of bounds for axis with size {size}')
+                bounds.append((k, k+1))
+                window_key.append(0)
+            else:
+                bounds.append((0, size))
+                window_key.append(k)
+        bands = np.arange(1, self.shape[0]+1)[key[0]]
+        with rasterio.open(self.filepath) as fh:
+            window = fh.read(np.atleast_1d(bands).tolist(), window=rasterio.windows.Window.from_slices(*bounds))
+        if np.ndim(bands) == 0:
+            window = window[0]
+        return window[(Ellipsis, *window_key)]
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        image = self.read()
+        return image if dtype is None else image.astype(dtype)
+
+    def __str__(self) -> str:
+        return f'LazyGeoTiff{{filepath : \'{self.filepath}\', shape : {self.shape}}}'
+
+    def __repr__(self) -> str:
+        return f'LazyGeoTiff{{filepath : \'{self.filepath}\', shape : {self.shape}, dtype : {self.dtype}}}'
+
 class MapSegmentation(BaseModel):
     """
     A segmentation mask for a map. 
@@ -394,9 +862,10 @@ class MapSegmentation(BaseModel):
         description='Information about the source the mask orginated from')
     type : MapUnitType = Field(
         description='The type of the map unit this mask is for')
-    image : np.ndarray = Field(
+    image : Union[np.ndarray, RLEArray] = Field(
         description="""The segmentation mask of the map. This is a single image with the value of each pixel being
-                    the map unit index in the legend.features""")
+                    the map unit index in the legend.features. Either an array or a compact RLEArray that decodes on
+                    access""")
     confidence : Optional[float] = Field(
         default=None,
         description='The confidence of the mask')
@@ -404,6 +873,11 @@ class MapSegmentation(BaseModel):
     class Config:
         arbitrary_types_allowed = True
 
+    def compact(self, encoding:str='rle'):
+        """Store the image compactly. encoding can be 'rle' for a RLEArray or 'dtype' for an array in the smallest
+        integer dtype that fits it."""
+        self.image = _compact_array(self.image, encoding)
+
 class CMAAS_Map(BaseModel):
     """
     Contains all of the CMAAS data for a map.
@@ -413,9 +887,9 @@ class CMAAS_Map(BaseModel):
     cog_id : Optional[str] = Field(
         default=None,
         description='The CDR provided cog_id of the map')
-    image : Optional[np.ndarray] = Field(
+    image : Optional[Union[np.ndarray, LazyGeoTiff]] = Field(
         default=None,
-        description='The map image')
+        description='The map image. Either a (C,H,W) array or a LazyGeoTiff handle that reads the image on demand')
     metadata : Optional[CMAAS_MapMetadata] = Field(
         default=None,
         description='The metadata for the map')
@@ -435,6 +909,16 @@ class CMAAS_Map(BaseModel):
     class Config:
         arbitrary_types_allowed = True
 
+    def compact(self, image_encoding:str='rle', mask_encoding:str='sparse'):
+        """Store the segmentation images and the masks of the legend map units compactly. See MapSegmentation.compact
+        and MapUnitSegmentation.compact for the encodings."""
+        for segmentation in self.segmentations:
+            segmentation.compact(image_encoding)
+        if self.legend is not None:
+            for feature in self.legend.features:
+                if feature.segmentation is not None:
+                    feature.segmentation.compact(mask_encoding)
+
     def __str__(self) -> str:
         out_str = 'CMASS_Map{'
         out_str += f'name : \'{self.name}\', '
@@ -470,7 +954,6 @@ class CMAAS_Map(BaseModel):
             'metadata' : self.metadata.to_dict() if self.metadata is not None else None,
             'layout' : self.layout.to_dict() if self.layout is not None else None,
             'legend' : self.legend.to_dict() if self.legend is not None else None,
-            'georef' : [g.to_dict() for g in self.georef] if self.georef is not None else None,
-            'ocrtext' : self.ocrtext.to_dict() if self.ocrtext is not None else None
+            'georef' : self.georef.model_dump() if self.georef is not None else None,
         }
 # endregion CMAAS Map
@@ -1,11 +1,24 @@
 import cv2
+import rasterio
 import numpy as np
-from typing import List
-from shapely.geometry import shape
-from rasterio.features import shapes, sieve 
-from .types import AreaBoundary, Legend, MapSegmentation, MapUnitType,  MapUnitSegmentation
+import shapely
+from pathlib import Path
+from itertools import repeat
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Dict, List, Tuple, Union
+from shapely.geometry import Polygon, shape
+from shapely.ops import unary_union
+from rasterio.features import shapes, sieve
+from rasterio.transform import Affine
+from rasterio.windows import Window
+from .types import AreaBoundary, Legend, MapSegmentation, MapUnit, MapUnitType,  MapUnitSegmentation, Provenance, as_geometry_array
 
-def generate_poly_geometry(segmentation:MapSegmentation, legend:Legend, noise_threshold=10):
+# Width of the mosaic that the windows around noise clusters are packed into when vectorizing in a single pass
+_MOSAIC_WIDTH = 2048
+
+def generate_poly_geometry(segmentation:MapSegmentation, legend:Legend, noise_threshold=10, single_pass=False, tile_size=None, workers=1, geometry_array=False):
     """
     Generate vector polygon geometry for each map unit in the legend from the segmentation mask.
 
@@ -13,57 +26,523 @@ def generate_poly_geometry(segmentation:MapSegmentation, legend:Legend, noise_th
         segmentation (MapSegmentation): The segmentation mask for the map.
         legend (Legend): The legend for the map.
         noise_threshold (int, optional): The number of pixels that can be considered noise. Defaults to 10.
+        single_pass (bool, optional): Vectorize every label of the segmentation in one pass instead of once per map
+            unit. Produces the same geometry as the per unit method. Defaults to False.
+        tile_size (int, optional): Vectorize the segmentation in tiles of this size, stitching together the polygons
+            that cross tile edges. Each tile is vectorized in a single pass. Produces the same geometry as the per unit
+            method. Defaults to None.
+        workers (int, optional): The number of processes to vectorize map units, or tiles if tile_size is set, with. The
+            single pass method always runs in one process. Defaults to 1.
+        geometry_array (bool, optional): Store the geometry of each feature as a shapely 2 array of geometries instead
+            of a list. Defaults to False.
 
     Returns:
         Legend: The legend with the polygon geometry added to each feature
     """
-    legend_index = 1
-    for feature in legend.features:
-        if feature.type != MapUnitType.POLYGON:
-            continue
-        # Get mask of feature
-        feature_mask = np.zeros_like(segmentation.image, dtype=np.uint8)
-        feature_mask[segmentation.image == legend_index] = 1
-        # Remove "noise" from mask by removing pixel groups smaller then the threshold
-        sieve_img = sieve(feature_mask, noise_threshold, connectivity=4)
-        # Convert mask to vector shapes
-        shape_gen = shapes(sieve_img, connectivity=4)
-        # Only use Filled pixels (1s) for shapes 
-        geometries = [shape(geometry) for geometry, value in shape_gen if value == 1]
+    # Vectorization needs a dense 2d image, compact images are decoded once here
+    image = _label_image(segmentation.image)
+    poly_indices = _get_legend_indices(legend, MapUnitType.POLYGON)
+    legend_indices = [i for i, _ in poly_indices]
+    if tile_size is not None:
+        label_geometries = vectorize_labels_tiled(image, legend_indices, noise_threshold, tile_size, workers)
+        geometries = [label_geometries.get(i, []) for i in legend_indices]
+    elif single_pass:
+        label_geometries = vectorize_labels(image, legend_indices, noise_threshold)
+        geometries = [label_geometries.get(i, []) for i in legend_indices]
+    else:
+        label_bounds = find_label_bounds(image, legend_indices)
+        unit_args = (legend_indices, repeat(noise_threshold), [label_bounds.get(i) for i in legend_indices])
+        with _label_workers(image, workers) as executor:
+            if executor is None:
+                geometries = [_vectorize_label(image, *args) for args in zip(*unit_args)]
+            else:
+                geometries = list(executor.map(_vectorize_shared_label, *unit_args))
+
+    for (_, feature), unit_geometry in zip(poly_indices, geometries):
+        if geometry_array:
+            unit_geometry = as_geometry_array(unit_geometry)
         # Add geometry to feature segmentation
-        feature.segmentation = MapUnitSegmentation(provenance=segmentation.provenance, geometry=geometries, confidence=segmentation.confidence)
-        legend_index += 1
+        feature.segmentation = MapUnitSegmentation(provenance=segmentation.provenance, geometry=unit_geometry, confidence=segmentation.confidence)
+    return legend
+
+def generate_poly_geometry_from_file(filepath:Path, legend:Legend, provenance:Provenance, noise_threshold=10, tile_size=2048, confidence=None, workers=1):
+    """
+    Generate vector polygon geometry for each map unit in the legend from a segmentation mask saved as a GeoTiff. The
+    mask is read and vectorized one tile at a time so that only a tile of it is ever in memory.
+
+    Args:
+        filepath (Path): The GeoTiff of the segmentation mask for the map. Only the first band is used.
+        legend (Legend): The legend for the map.
+        provenance (Provenance): The provenance of the segmentation mask.
+        noise_threshold (int, optional): The number of pixels that can be considered noise. Defaults to 10.
+        tile_size (int, optional): The size of the tiles to vectorize the segmentation in. Defaults to 2048.
+        confidence (float, optional): The confidence of the segmentation mask. Defaults to None.
+        workers (int, optional): The number of processes to vectorize tiles with. Defaults to 1.
+
+    Returns:
+        Legend: The legend with the polygon geometry added to each feature
+    """
+    poly_indices = _get_legend_indices(legend, MapUnitType.POLYGON)
+    label_geometries = vectorize_labels_tiled(filepath, [i for i, _ in poly_indices], noise_threshold, tile_size, workers)
+    for legend_index, feature in poly_indices:
+        feature.segmentation = MapUnitSegmentation(provenance=provenance, geometry=label_geometries.get(legend_index, []), confidence=confidence)
     return legend
 
-def generate_point_geometry(segmentation:MapSegmentation, legend:Legend):
+def _get_legend_indices(legend:Legend, unit_type:MapUnitType) -> List[Tuple[int, MapUnit]]:
+    """Returns the map units of unit_type paired with the value they have in a segmentation mask."""
+    indices = []
+    for feature in legend.features:
+        if feature.type == unit_type:
+            indices.append((len(indices) + 1, feature))
+    return indices
+
+def _vectorize_label(image:np.ndarray, legend_index:int, noise_threshold:int, bounds:Tuple[slice, slice]) -> List[Polygon]:
+    """Vectorizes a single label of a segmentation mask within the bounds of the label. Returns a list of polygons."""
+    if bounds is None:
+        return []
+    # Crop to the label with enough padding that the area around it is never mistaken for noise
+    (y0, y1), (x0, x1) = _pad_bounds(bounds, noise_threshold + 1, image.shape)
+    # Get mask of feature
+    feature_mask = (image[y0:y1, x0:x1] == legend_index).astype(np.uint8)
+    # Remove "noise" from mask by removing pixel groups smaller then the threshold
+    sieve_img = sieve(feature_mask, noise_threshold, connectivity=4)
+    # Convert mask to vector shapes
+    shape_gen = shapes(sieve_img, connectivity=4, transform=Affine.translation(x0, y0))
+    # Only use Filled pixels (1s) for shapes 
+    return [shape(geometry) for geometry, value in shape_gen if value == 1]
+
+def find_label_bounds(image:np.ndarray, labels=None, block_size:int=256) -> Dict[int, Tuple[slice, slice]]:
+    """
+    Find the bounding box of labels in a segmentation mask in a single pass over the image.
+
+    Args:
+        image (np.ndarray): The segmentation mask, a 2d array or a single band (1,H,W) array of integer labels.
+        labels (List[int], optional): The labels to find. Pixels with any other value, such as nodata, are ignored.
+            Defaults to every label in the image.
+        block_size (int, optional): The number of rows of the image to process at a time. Defaults to 256.
+
+    Returns:
+        Dict[int, Tuple[slice, slice]]: The row and column slices of each of the labels that is present in the image.
+    """
+    image = _label_image(image)
+    height, width = image.shape
+    labels = np.unique(image) if labels is None else np.unique(np.asarray(labels))
+    if len(labels) == 0 or image.size == 0:
+        return {}
+    # Bin 0 collects every pixel that is not one of the labels
+    num_bins = len(labels) + 1
+    row_present = np.zeros((num_bins, height), dtype=bool)
+    col_present = np.zeros((num_bins, width), dtype=bool)
+    for start in range(0, height, block_size):
+        block = image[start:start+block_size]
+        rows = block.shape[0]
+        # Replace each pixel with the bin of its label
+        index = np.minimum(np.searchsorted(labels, block), len(labels) - 1)
+        bins = np.where(labels[index] == block, index + 1, 0).astype(np.intp)
+        # Count each (bin, row) and (bin, col) pair in the block
+        row_counts = np.bincount((bins * rows + np.arange(rows)[:,None]).ravel(), minlength=num_bins*rows)
+        row_present[:, start:start+rows] = row_counts.reshape(num_bins, rows) > 0
+        col_counts = np.bincount((bins * width + np.arange(width)).ravel(), minlength=num_bins*width)
+        col_present |= col_counts.reshape(num_bins, width) > 0
+
+    found = np.flatnonzero(row_present[1:].any(axis=1)) + 1
+    row_start = row_present[found].argmax(axis=1)
+    row_stop = height - row_present[found, ::-1].argmax(axis=1)
+    col_start = col_present[found].argmax(axis=1)
+    col_stop = width - col_present[found, ::-1].argmax(axis=1)
+    return {int(labels[b-1]) : (slice(int(r0), int(r1)), slice(int(c0), int(c1))) for b, r0, r1, c0, c1 in zip(found, row_start, row_stop, col_start, col_stop)}
+
+def _label_image(image) -> np.ndarray:
+    """Returns a segmentation mask as a 2d array, dropping the band axis of a single band (1,H,W) array."""
+    image = np.asarray(image)
+    if image.ndim == 3 and image.shape[0] == 1:
+        return image[0]
+    if image.ndim != 2:
+        raise ValueError(f'Segmentation mask must be a 2d or single band (1,H,W) array, got an array of shape {image.shape}')
+    return image
+
+def _pad_bounds(bounds:Tuple[slice, slice], pad:int, shape:Tuple[int, int]) -> Tuple[Tuple[int, int], Tuple[int, int]]:
+    """Pads the row and column slices of a bounding box, clipped to the image shape."""
+    rows, cols = bounds
+    return (max(rows.start - pad, 0), min(rows.stop + pad, shape[0])), (max(cols.start - pad, 0), min(cols.stop + pad, shape[1]))
+
+def vectorize_labels(image:np.ndarray, labels, noise_threshold:int=10) -> Dict[int, List[Polygon]]:
+    """
+    Vectorize every label of a segmentation mask in a single pass. The result for each label is the same geometry
+    that sieving and polygonizing a binary mask of just that label would produce.
+
+    Regions of the mask that are at least noise_threshold pixels are unaffected by sieving any binary label mask, so
+    only the noise, the smaller regions, has to be resolved. The noise is found and grouped into clusters of touching
+    regions on the raster. A cluster that is a single region is kept by the label around it if it is surrounded by
+    only one label and is removed otherwise, any other cluster is resolved by sieving a window around it for each label
+    that touches it. The mask with the noise resolved is then polygonized once. The few labels that would keep the same
+    noise pixel as another label are vectorized on their own instead.
+
+    Args:
+        image (np.ndarray): The segmentation mask, a 2d array of integer labels.
+        labels (Iterable[int]): The labels to vectorize.
+        noise_threshold (int, optional): The number of pixels that can be considered noise. Defaults to 10.
+
+    Returns:
+        Dict[int, List[Polygon]]: The polygons of each label that had any geometry.
+    """
+    labels = set(int(l) for l in labels)
+    image = _as_shapes_dtype(image)
+    cluster_ids, cluster_bounds = _find_noise_clusters(image, noise_threshold)
+
+    # Replace the noise with the label that keeps it
+    resolved = image.copy()
+    keep = np.isin(image, list(labels)) & (cluster_ids == 0)
+    shared_labels = set()
+    if len(cluster_bounds) > 1:
+        kept_pixels, kept_labels = _resolve_noise_clusters(image, cluster_ids, cluster_bounds, labels, noise_threshold)
+        _, pixel_index, pixel_counts = np.unique(kept_pixels, return_inverse=True, return_counts=True)
+        shared_labels = set(np.unique(kept_labels[pixel_counts[pixel_index] > 1]).tolist())
+        resolved.flat[kept_pixels] = kept_labels
+        keep.flat[kept_pixels] = True
+
+    # Polygonize every label at once
+    regions = {}
+    for geometry, value in shapes(resolved, mask=keep, connectivity=4):
+        if int(value) not in shared_labels:
+            regions.setdefault(int(value), []).append(shape(geometry))
+
+    # A pixel can only have one label in the resolved mask, labels that share one are vectorized from their own mask
+    if len(shared_labels) > 0:
+        label_bounds = find_label_bounds(image, sorted(shared_labels))
+        for label in shared_labels:
+            polygons = _vectorize_label(image, label, noise_threshold, label_bounds.get(label))
+            if len(polygons) > 0:
+                regions[label] = polygons
+    return regions
+
+def vectorize_labels_tiled(source:Union[np.ndarray, Path], labels, noise_threshold:int=10, tile_size:int=2048, workers:int=1) -> Dict[int, List[Polygon]]:
+    """
+    Vectorize every label of a segmentation mask one tile at a time. The result for each label is the same geometry
+    that sieving and polygonizing a binary mask of just that label would produce.
+
+    Each tile is read with a halo around it that is large enough for the sieve to make the same decisions inside the
+    tile as it would on the whole mask. The vectorized tile is clipped back to its own area and any polygons that touch
+    the edge of the tile are merged with the polygons from the neighbouring tiles once all tiles are done.
+
+    Args:
+        source (np.ndarray | Path): The segmentation mask, either a 2d array of integer labels or the path to a GeoTiff
+            of it. Only the first band of a GeoTiff is used.
+        labels (Iterable[int]): The labels to vectorize.
+        noise_threshold (int, optional): The number of pixels that can be considered noise. Defaults to 10.
+        tile_size (int, optional): The size of the tiles to vectorize. Defaults to 2048.
+        workers (int, optional): The number of processes to vectorize tiles with. Defaults to 1.
+
+    Returns:
+        Dict[int, List[Polygon]]: The polygons of each label that had any geometry.
+    """
+    labels = set(int(l) for l in labels)
+    if isinstance(source, np.ndarray):
+        height, width = source.shape
+    else:
+        with rasterio.open(source) as fh:
+            height, width = fh.height, fh.width
+    tiles = [(y0, x0) for y0 in range(0, height, tile_size) for x0 in range(0, width, tile_size)]
+    tile_args = (tile_size, labels, noise_threshold)
+
+    regions = {}
+    seam_regions = {}
+    with _label_workers(source, workers) as executor:
+        if executor is None:
+            with _open_label_source(source) as label_source:
+                tile_results = [_vectorize_tile(label_source, y0, x0, *tile_args) for y0, x0 in tiles]
+        else:
+            tile_results = executor.map(_vectorize_shared_tile, tiles, repeat(tile_args))
+        for tile_regions in tile_results:
+            for label, (polygons, seam_polygons) in tile_regions.items():
+                regions.setdefault(label, []).extend(polygons)
+                seam_regions.setdefault(label, []).extend(seam_polygons)
+
+    # Stitch together the polygons that were split by tile edges
+    for label, polygons in seam_regions.items():
+        if len(polygons) > 0:
+            regions[label].extend(shapely.get_parts(unary_union(polygons)))
+    return {label : polygons for label, polygons in regions.items() if len(polygons) > 0}
+
+def _vectorize_tile(label_source, y0:int, x0:int, tile_size:int, labels:set, noise_threshold:int) -> Dict[int, Tuple[List[Polygon], List[Polygon]]]:
+    """Vectorizes the tile of a segmentation mask starting at (y0, x0). Returns the polygons of each label split into the
+    ones inside the tile and the ones that touch an edge shared with another tile."""
+    height, width = label_source.shape[-2:]
+    y1, x1 = min(y0 + tile_size, height), min(x0 + tile_size, width)
+    (wy0, wy1), (wx0, wx1) = _pad_bounds((slice(y0, y1), slice(x0, x1)), 2 * noise_threshold + 2, (height, width))
+    window = _read_label_window(label_source, wy0, wy1, wx0, wx1)
+    tile = shapely.box(x0 - wx0, y0 - wy0, x1 - wx0, y1 - wy0)
+    # Edges of the tile that are shared with another tile
+    seams = (x0 > 0, y0 > 0, x1 < width, y1 < height)
+
+    tile_regions = {}
+    for label, polygons in vectorize_labels(window, labels, noise_threshold).items():
+        clipped = shapely.get_parts(shapely.intersection(polygons, tile))
+        clipped = shapely.transform(clipped[shapely.area(clipped) > 0], lambda c: c + [wx0, wy0])
+        bounds = shapely.bounds(clipped)
+        on_seam = np.zeros(len(clipped), dtype=bool)
+        for i, (edge, is_seam) in enumerate(zip((x0, y0, x1, y1), seams)):
+            if is_seam:
+                on_seam |= bounds[:,i] == edge
+        tile_regions[label] = (list(clipped[~on_seam]), list(clipped[on_seam]))
+    return tile_regions
+
+@contextmanager
+def _open_label_source(source:Union[np.ndarray, Path]):
+    """Opens a segmentation mask for reading by window."""
+    if isinstance(source, np.ndarray):
+        yield source
+    else:
+        with rasterio.open(source) as fh:
+            yield fh
+
+def _read_label_window(label_source, y0:int, y1:int, x0:int, x1:int) -> np.ndarray:
+    """Reads the window [y0:y1, x0:x1] of an open segmentation mask."""
+    if isinstance(label_source, np.ndarray):
+        return label_source[y0:y1, x0:x1]
+    return label_source.read(1, window=Window.from_slices((y0, y1), (x0, x1)))
+
+# region Parallel Vectorization
+# The segmentation mask that worker processes read from. Set by _init_label_worker.
+_worker_label_source = None
+_worker_shared_memory = None
+
+@contextmanager
+def _label_workers(source:Union[np.ndarray, Path], workers:int):
+    """
+    Starts a process pool whose workers can all read the segmentation mask. An in memory mask is copied once into
+    shared memory rather than being pickled to each worker, a GeoTiff is opened by each worker. Yields None if only a
+    single worker is requested.
+    """
+    if workers is None or workers <= 1:
+        yield None
+        return
+    shm = None
+    try:
+        if isinstance(source, np.ndarray):
+            shm = shared_memory.SharedMemory(create=True, size=max(source.nbytes, 1))
+            np.ndarray(source.shape, dtype=source.dtype, buffer=shm.buf)[...] = source
+            initargs = (shm.name, source.shape, source.dtype.str)
+        else:
+            initargs = (source,)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_label_worker, initargs=initargs) as executor:
+            yield executor
+    finally:
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+
+def _init_label_worker(source:Union[str, Path], shape:Tuple[int, int]=None, dtype:str=None):
+    """Attaches a worker process to the shared segmentation mask."""
+    global _worker_label_source, _worker_shared_memory
+    if shape is None:
+        _worker_label_source = rasterio.open(source)
+        return
+    _worker_shared_memory = shared_memory.SharedMemory(name=source)
+    _worker_label_source = np.ndarray(shape, dtype=np.dtype(dtype), buffer=_worker_shared_memory.buf)
+
+def _vectorize_shared_tile(tile:Tuple[int, int], tile_args:tuple):
+    return _vectorize_tile(_worker_label_source, *tile, *tile_args)
+
+def _vectorize_shared_label(legend_index:int, noise_threshold:int, bounds:Tuple[slice, slice]) -> List[Polygon]:
+    return _vectorize_label(_worker_label_source, legend_index, noise_threshold, bounds)
+# endregion Parallel Vectorization
+
+def _find_noise_clusters(image:np.ndarray, noise_threshold:int) -> Tuple[np.ndarray, np.ndarray]:
+    """Finds the noise of a segmentation mask, the 4-connected regions of equal pixels smaller than noise_threshold,
+    and groups touching noise regions into clusters. Returns the cluster id of every pixel, 0 for pixels that are not
+    noise, and the [x, y, width, height] bounding box of each cluster id."""
+    noise = np.zeros(image.shape, dtype=np.uint8)
+    if noise_threshold > 1:
+        for value, (rows, cols) in find_label_bounds(image).items():
+            _, regions, stats, _ = cv2.connectedComponentsWithStats((image[rows, cols] == value).astype(np.uint8), connectivity=4, ltype=cv2.CV_32S)
+            small = stats[:, cv2.CC_STAT_AREA] < noise_threshold
+            # Component 0 is the pixels of other values
+            small[0] = False
+            noise[rows, cols] |= small[regions]
+    _, cluster_ids, stats, _ = cv2.connectedComponentsWithStats(noise, connectivity=4, ltype=cv2.CV_32S)
+    return cluster_ids, stats[:, :4].astype(np.int64)
+
+def _resolve_noise_clusters(image:np.ndarray, cluster_ids:np.ndarray, cluster_bounds:np.ndarray, labels:set, noise_threshold:int) -> Tuple[np.ndarray, np.ndarray]:
+    """Finds the noise pixels that each of labels keeps when its binary mask is sieved. Returns the flat index of each
+    kept pixel and the label that keeps it. A pixel can be kept by more than one label."""
+    height, width = image.shape
+    num_clusters = len(cluster_bounds)
+    ys, xs = np.nonzero(cluster_ids)
+    ids = cluster_ids[ys, xs].astype(np.int64)
+    values = image[ys, xs].astype(np.int64)
+
+    # The distinct values in each cluster, and in each cluster together with the pixels around it
+    inner = np.unique(np.stack([ids, values], axis=1), axis=0)
+    touch_ids, touch_values = [ids], [values]
+    for dy, dx in ((-1, 0), (1, 0), (0, -1), (0, 1)):
+        ny, nx = ys + dy, xs + dx
+        inside = (ny >= 0) & (ny < height) & (nx >= 0) & (nx < width)
+        touch_ids.append(ids[inside])
+        touch_values.append(image[ny[inside], nx[inside]].astype(np.int64))
+    touching = np.unique(np.stack([np.concatenate(touch_ids), np.concatenate(touch_values)], axis=1), axis=0)
+    inner_counts = np.bincount(inner[:,0], minlength=num_clusters)
+    touching_counts = np.bincount(touching[:,0], minlength=num_clusters)
+    cluster_values = np.zeros(num_clusters, dtype=np.int64)
+    cluster_values[inner[:,0]] = inner[:,1]
+    label_list = list(labels)
+
+    # A cluster that is a single region is kept by the only label around it. It is removed if there is more then one,
+    # and kept by its own label if nothing is around it.
+    single = (inner_counts == 1)[touching[:,0]]
+    num_around = touching_counts[touching[:,0]] - 1
+    single_kept = touching[single & (((num_around == 1) & (touching[:,1] != cluster_values[touching[:,0]])) | (num_around == 0))]
+    single_kept = single_kept[np.isin(single_kept[:,1], label_list)]
+    is_kept = np.zeros(num_clusters, dtype=bool)
+    is_kept[single_kept[:,0]] = True
+    kept_by = np.zeros(num_clusters, dtype=np.int64)
+    kept_by[single_kept[:,0]] = single_kept[:,1]
+    kept = is_kept[ids]
+    kept_pixels, kept_labels = [ys[kept] * width + xs[kept]], [kept_by[ids[kept]]]
+
+    # Any other cluster can only be kept by a label in or around it
+    multiple = touching[~single & np.isin(touching[:,1], label_list)]
+    for label in np.unique(multiple[:,1]).tolist():
+        pixels = _sieve_clusters(image, cluster_ids, cluster_bounds, multiple[multiple[:,1] == label, 0], label, noise_threshold)
+        kept_pixels.append(pixels)
+        kept_labels.append(np.full(len(pixels), label, dtype=np.int64))
+    return np.concatenate(kept_pixels), np.concatenate(kept_labels)
+
+def _sieve_clusters(image:np.ndarray, cluster_ids:np.ndarray, cluster_bounds:np.ndarray, clusters:np.ndarray, label:int, noise_threshold:int) -> np.ndarray:
+    """Sieves a window around each of clusters in the binary mask of label. Returns the flat index of every pixel of
+    the clusters that the label keeps."""
+    height, width = image.shape
+    # Any component in a window that reaches the edge of the padding is larger then the threshold
+    pad = noise_threshold + 1
+    x, y, w, h = cluster_bounds[clusters].T
+    x0, y0 = np.maximum(x - pad, 0), np.maximum(y - pad, 0)
+    x1, y1 = np.minimum(x + w + pad, width), np.minimum(y + h + pad, height)
+    offsets, mosaic_shape = _pack_windows(y1 - y0, x1 - x0, _MOSAIC_WIDTH)
+    windows = list(zip(clusters.tolist(), y0.tolist(), y1.tolist(), x0.tolist(), x1.tolist(), offsets.tolist()))
+
+    # Sieve every window at once. The gaps between windows are masked out, which sieve treats the same as the edge of
+    # the image.
+    mosaic = np.zeros(mosaic_shape, dtype=np.uint8)
+    valid = np.zeros(mosaic_shape, dtype=bool)
+    for _, wy0, wy1, wx0, wx1, (oy, ox) in windows:
+        mosaic[oy:oy+wy1-wy0, ox:ox+wx1-wx0] = image[wy0:wy1, wx0:wx1] == label
+        valid[oy:oy+wy1-wy0, ox:ox+wx1-wx0] = True
+    sieved = sieve(mosaic, noise_threshold, mask=valid, connectivity=4)
+
+    pixels = []
+    for cluster, wy0, wy1, wx0, wx1, (oy, ox) in windows:
+        kept_y, kept_x = np.nonzero((sieved[oy:oy+wy1-wy0, ox:ox+wx1-wx0] == 1) & (cluster_ids[wy0:wy1, wx0:wx1] == cluster))
+        pixels.append((kept_y + wy0) * width + kept_x + wx0)
+    return np.concatenate(pixels)
+
+def _pack_windows(heights:np.ndarray, widths:np.ndarray, max_width:int) -> Tuple[np.ndarray, Tuple[int, int]]:
+    """Packs windows into rows of at most max_width, tallest first, with a one pixel gap around each window. Returns
+    the [row, col] offset of each window and the shape of the packed image."""
+    offsets = np.zeros((len(heights), 2), dtype=np.int64)
+    row_y, row_height, col_x, packed_width = 0, 0, 0, 0
+    for i in np.argsort(-heights, kind='stable').tolist():
+        if col_x > 0 and col_x + widths[i] > max_width:
+            row_y, row_height, col_x = row_y + row_height + 1, 0, 0
+        offsets[i] = (row_y, col_x)
+        row_height = max(row_height, int(heights[i]))
+        col_x += int(widths[i]) + 1
+        packed_width = max(packed_width, col_x - 1)
+    return offsets, (row_y + row_height, packed_width)
+
+def _as_shapes_dtype(image:np.ndarray) -> np.ndarray:
+    """Casts a label image to a dtype that rasterio can polygonize if needed."""
+    if image.dtype in (np.uint8, np.uint16, np.int16, np.int32):
+        return image
+    return image.astype(np.int32)
+
+def generate_point_geometry(segmentation:MapSegmentation, legend:Legend, connected_components=False, component_stats=False):
     """
     Generate vector point geometry for each map unit in the legend from the segmentation mask.
     
     Args:
         segmentation (MapSegmentation): The segmentation mask for the map.
         legend (Legend): The legend for the map.
+        connected_components (bool, optional): Instead of a point for every pixel, create one point at the centroid of
+            each connected group of pixels of a map unit. Defaults to False.
+        component_stats (bool, optional): Also store the pixel count and bounding box of each connected group of pixels.
+            Only used with connected_components. Defaults to False.
         
     Returns:
-        Legend: The legend with the point geometry added to each feature
+        Legend: The legend with the points of each feature stored as an (N,2) array of [x,y] pixel coordinates in the
+            points field of its segmentation
     """
-    legend_index = 1
-    for feature in legend.features:
-        if feature.type != MapUnitType.POINT:
-            continue
-        # Get mask of feature
-        feature_mask = np.zeros_like(segmentation.image, dtype=np.uint8)
-        feature_mask[segmentation.image == legend_index] = 1
-        # Get points from mask
-        point_geometry = np.transpose(feature_mask.nonzero())
-        # Convert geometry to List(List(List(float)))
-        point_geometry = [[point] for point in point_geometry]
-        feature.segmentation = MapUnitSegmentation(provenance=segmentation.provenance, geometry=point_geometry, confidence=segmentation.confidence)
-        legend_index += 1
+    if connected_components:
+        return _generate_point_components(segmentation, legend, component_stats)
+
+    image = _label_image(segmentation.image)
+    point_indices = _get_legend_indices(legend, MapUnitType.POINT)
+    label_bounds = find_label_bounds(image, [i for i, _ in point_indices])
+    for legend_index, feature in point_indices:
+        points = np.empty((0,2), dtype=np.intp)
+        if legend_index in label_bounds:
+            rows, cols = label_bounds[legend_index]
+            # Get [x,y] pixel coordinates from mask of feature
+            ys, xs = (image[rows, cols] == legend_index).nonzero()
+            points = np.stack([xs + cols.start, ys + rows.start], axis=1)
+        feature.segmentation = MapUnitSegmentation(provenance=segmentation.provenance, points=points, confidence=segmentation.confidence)
+    return legend
+
+def _generate_point_components(segmentation:MapSegmentation, legend:Legend, component_stats:bool):
+    """Sets the points of each point map unit to the centroids of its connected components. All point map units are
+    labeled in one pass, components where two units touch are split by unit."""
+    point_indices = _get_legend_indices(legend, MapUnitType.POINT)
+    num_units = len(point_indices)
+    image = _label_image(segmentation.image)
+    label_bounds = find_label_bounds(image, range(1, num_units+1))
+    point_bounds = list(label_bounds.values())
+
+    # Label connected pixels of every point unit at once, within the area that has any point pixels
+    if len(point_bounds) > 0:
+        y0, y1 = min(b[0].start for b in point_bounds), max(b[0].stop for b in point_bounds)
+        x0, x1 = min(b[1].start for b in point_bounds), max(b[1].stop for b in point_bounds)
+        image = image[y0:y1, x0:x1]
+        point_mask = ((image > 0) & (image <= num_units)).astype(np.uint8)
+        _, components = cv2.connectedComponents(point_mask, connectivity=8, ltype=cv2.CV_32S)
+        ys, xs = point_mask.nonzero()
+    else:
+        y0, x0 = 0, 0
+        ys, xs = np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+
+    # Group pixels by component and unit
+    if len(ys) > 0:
+        units = image[ys, xs].astype(np.int64)
+        groups, group_ids = np.unique(components[ys, xs].astype(np.int64) * (num_units+1) + units, return_inverse=True)
+    else:
+        groups, group_ids = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.intp)
+    group_units = groups % (num_units+1)
+    sizes = np.bincount(group_ids, minlength=len(groups))
+    centroids = np.stack([np.bincount(group_ids, xs, minlength=len(groups)), np.bincount(group_ids, ys, minlength=len(groups))], axis=1)
+    centroids = centroids / np.maximum(sizes, 1)[:,None] + [x0, y0]
+    if component_stats:
+        order = np.argsort(group_ids, kind='stable')
+        starts = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(np.intp)
+        bboxes = np.empty((len(groups), 4), dtype=np.int64)
+        if len(groups) > 0:
+            bboxes[:,0] = np.minimum.reduceat(xs[order], starts) + x0
+            bboxes[:,1] = np.minimum.reduceat(ys[order], starts) + y0
+            bboxes[:,2] = np.maximum.reduceat(xs[order], starts) + x0
+            bboxes[:,3] = np.maximum.reduceat(ys[order], starts) + y0
+
+    # Split the components by unit
+    unit_order = np.argsort(group_units, kind='stable')
+    unit_starts = np.searchsorted(group_units[unit_order], np.arange(1, num_units+2))
+    for legend_index, feature in point_indices:
+        unit_groups = unit_order[unit_starts[legend_index-1]:unit_starts[legend_index]]
+        feature.segmentation = MapUnitSegmentation(provenance=segmentation.provenance, confidence=segmentation.confidence, points=centroids[unit_groups])
+        if component_stats:
+            feature.segmentation.point_sizes = sizes[unit_groups]
+            feature.segmentation.point_bboxes = bboxes[unit_groups]
     return legend
 
 def mask_and_crop(image, areas):
     """
-    Mask and crop an image based on a list of areas.
+    Mask and crop an image based on a list of areas. Only the bounding box of the areas is ever masked, the rest of
+    the image is not copied.
 
     Args:
         image (np.array): The image to mask and crop, should be numpy array of shape (C,H,W)
@@ -73,17 +552,26 @@ def mask_and_crop(image, areas):
         np.array: The masked and cropped image.
         Tuple[int,int]: The x and y offset of the cropped image from the top left of the original. 
     """
-    # Create a mask of the image
-    t_img = image.transpose(1,2,0).copy()
-    mask = np.zeros(t_img.shape[:2], dtype=np.uint8)
+    # Find the bounding box of the areas within the image
+    height, width = image.shape[1:]
+    x0, y0, x1, y1 = 0, 0, 0, 0
+    coords = [np.asarray(ring).reshape(-1,2) for area in areas for ring in area.geometry]
+    if len(coords) > 0:
+        coords = np.concatenate(coords)
+        x0, y0 = np.maximum(np.floor(coords.min(axis=0)).astype(int), 0)
+        x1, y1 = np.minimum(np.ceil(coords.max(axis=0)).astype(int) + 1, [width, height])
+    # Create a mask of just the bounding box
+    mask = np.zeros((max(y1 - y0, 0), max(x1 - x0, 0)), dtype=np.uint8)
+    if mask.size == 0:
+        return image[:, 0:0, 0:0].copy(), (0,0)
     for area in areas:
-        cv2.fillPoly(mask, [np.array(area.geometry, dtype=np.int32)], 255)
-    # Mask the image
-    masked_img = cv2.bitwise_and(t_img, t_img, mask=mask)
-    if len(masked_img.shape) == 2:
-        masked_img = np.expand_dims(masked_img, axis=2)
-    # Crop the image
+        cv2.fillPoly(mask, [np.array(area.geometry, dtype=np.int32)], 1, offset=(-int(x0), -int(y0)))
+    # Crop to the filled part of the mask
     x, y, w, h = cv2.boundingRect(mask)
-    cropped_img = masked_img[y:y+h, x:x+w]
-    cropped_img = cropped_img.transpose(2,0,1)
-    return cropped_img, (x,y)
\ No newline at end of file
+    if w == 0 or h == 0:
+        return image[:, 0:0, 0:0].copy(), (0,0)
+    mask = mask[y:y+h, x:x+w]
+    x, y = int(x0) + x, int(y0) + y
+    # Mask the image, np.where keeps the dtype of the image
+    cropped_img = np.where(mask.astype(bool), image[:, y:y+h, x:x+w], 0).astype(image.dtype, copy=False)
+    return cropped_img, (x,y)
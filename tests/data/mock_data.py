@@ -95,6 +95,28 @@ def get_mock_uncharted_layout():
     return mock_layout
 # endregion Layouts
 
+# region Segmentations
+def get_mock_poly_legend(num_units=6):
+    mock_legend = Legend(provenance=Provenance(name='MockData', version='0.1'))
+    for i in range(num_units):
+        mock_legend.features.append(MapUnit(type=MapUnitType.POLYGON, label=f'mock polygon unit {i}'))
+    mock_legend.features.append(MapUnit(type=MapUnitType.POINT, label='mock point unit'))
+    return mock_legend
+
+def get_mock_poly_segmentation(noise=0.02, seed=0, shape=(120,150), num_units=6):
+    # Overlapping rectangles for each unit with scattered noise pixels of every label on top
+    rng = np.random.default_rng(seed)
+    height, width = shape
+    image = np.zeros(shape, dtype=np.uint8)
+    for label in range(1,num_units+1):
+        for _ in range(3):
+            y, x = rng.integers(0, height), rng.integers(0, width)
+            image[y:y+rng.integers(5, height//3), x:x+rng.integers(5, width//3)] = label
+    noise_pixels = int(image.size * noise)
+    image[rng.integers(0, height, noise_pixels), rng.integers(0, width, noise_pixels)] = rng.integers(0, num_units+1, noise_pixels)
+    return MapSegmentation(provenance=Provenance(name='MockData', version='0.1'), type=MapUnitType.POLYGON, image=image)
+# endregion Segmentations
+
 # region Full Maps
 def get_mock_map():
     map_data = CMAAS_Map(name="mock_map_data")
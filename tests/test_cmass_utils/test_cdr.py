@@ -2,6 +2,8 @@ from tests.data import mock_data
 import src.cmaas_utils.cdr as cdr
 from tests.utilities import init_test_log
 import json
+import shapely
+from src.cmaas_utils.types import MapUnitSegmentation, Provenance
 from cdr_schemas.cdr_responses.legend_items import LegendItemResponse
 from cdr_schemas.cdr_responses.area_extractions import AreaExtractionResponse
 from cdr_schemas.feature_results import FeatureResults
@@ -22,6 +24,23 @@ class Test_CDRSchema:
         assert len(cdr_schema.cog_area_extractions) == 0
         
 
+    def test_export_mock_map_to_cdr_parallel(self):
+        map_data = mock_data.get_mock_map()
+        expected = cdr.exportMapToCDR(map_data, cog_id='1234')
+        cdr_schema = cdr.exportMapToCDR(map_data, cog_id='1234', workers=2)
+        assert cdr_schema.model_dump_json() == expected.model_dump_json()
+
+    def test_export_polygon_coordinates(self):
+        polygon = shapely.Polygon([[0, 0], [10, 0], [10, 10], [0, 10]], holes=[[[2, 2], [4, 2], [4, 4]]])
+        segmentation = MapUnitSegmentation(provenance=Provenance(name='Unit testing'), geometry=[polygon, shapely.box(20, 20, 21, 21)])
+        collection = cdr._build_CDR_poly_feature_collection(segmentation)
+        assert len(collection.features) == 2
+        assert collection.features[0].geometry.coordinates == [[[*point] for point in polygon.exterior.coords], [[*point] for point in polygon.interiors[0].coords]]
+        assert len(collection.features[1].geometry.coordinates) == 1
+
+        trusted_collection = cdr._build_CDR_poly_feature_collection(segmentation, trusted=True)
+        assert trusted_collection.model_dump_json() == collection.model_dump_json()
+
 class Test_ConvertCDRToCMAAS:
     def test_convert_CDR_feature_results_to_cmass_map(self):
         log = init_test_log("Test_ConvertCDRToCMAAS/test_convert_CDR_feature_results_to_cmass_map")
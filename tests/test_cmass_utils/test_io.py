@@ -1,14 +1,20 @@
 import pytest
 import os
 import copy
+import asyncio
+import shutil
 import numpy as np
+import shapely
+import geopandas as gpd
 from pathlib import Path
+from pydantic import ValidationError
 from rasterio.crs import CRS
 from rasterio.transform import Affine
 
 from tests.data import mock_data
-from src.cmaas_utils.types import CMAAS_Map, GeoReference, Legend, MapUnit, MapUnitType, Layout
+from src.cmaas_utils.types import CMAAS_Map, CMAAS_MapMetadata, GeoReference, LazyGeoTiff, Legend, MapSegmentation, MapUnit, MapUnitSegmentation, MapUnitType, Layout, Provenance
 import src.cmaas_utils.io as io
+import src.cmaas_utils.cdr as cdr
 
 def exec_loadLegendJson(filepath:Path, expected:Legend):
     result = io.loadLegendJson(filepath)
@@ -40,31 +46,31 @@ def exec_loadLegendJson(filepath:Path, expected:Legend):
 
 def exec_loadUSGSLegendJson(filepath:Path, expected:Legend):
     # Full Data
-    result = io._loadLegacyUSGSLegendJson(filepath)
+    result = io._parseLegacyUSGSLegendJson(io._loadJsonFile(filepath))
     assert result == expected
 
     # Poly Data Filter
     expected_poly = copy.deepcopy(expected)
     [expected_poly.features.remove(f) for f in expected.features if f.type != MapUnitType.POLYGON]
-    result = io._loadLegacyUSGSLegendJson(filepath, type_filter=[MapUnitType.POLYGON])
+    result = io._parseLegacyUSGSLegendJson(io._loadJsonFile(filepath), type_filter=[MapUnitType.POLYGON])
     assert result == expected_poly
 
     # Line Data Filter
     expected_line = copy.deepcopy(expected)
     [expected_line.features.remove(f) for f in expected.features if f.type != MapUnitType.LINE]
-    result = io._loadLegacyUSGSLegendJson(filepath, type_filter=[MapUnitType.LINE])
+    result = io._parseLegacyUSGSLegendJson(io._loadJsonFile(filepath), type_filter=[MapUnitType.LINE])
     assert result == expected_line
 
     # Point Data Filter
     expected_point = copy.deepcopy(expected)
     [expected_point.features.remove(f) for f in expected.features if f.type != MapUnitType.POINT]
-    result = io._loadLegacyUSGSLegendJson(filepath, type_filter=[MapUnitType.POINT])
+    result = io._parseLegacyUSGSLegendJson(io._loadJsonFile(filepath), type_filter=[MapUnitType.POINT])
     assert result == expected_point
 
     # Not Unknown Data
     expected_known = copy.deepcopy(expected)
     [expected_known.features.remove(f) for f in expected.features if f.type == MapUnitType.UNKNOWN]
-    result = io._loadLegacyUSGSLegendJson(filepath, type_filter=[MapUnitType.POINT, MapUnitType.LINE, MapUnitType.POLYGON])
+    result = io._parseLegacyUSGSLegendJson(io._loadJsonFile(filepath), type_filter=[MapUnitType.POINT, MapUnitType.LINE, MapUnitType.POLYGON])
     assert result == expected_known
 
 class Test_USGSLegendData:
@@ -104,18 +110,51 @@ class Test_USGSLegendData:
         exec_loadUSGSLegendJson(testfile, expected)
         exec_loadLegendJson(testfile, expected)
 
-    # TODO ParallelLoadLegends Test
+    @pytest.mark.parametrize('backend', list(io._json_backends.keys()))
+    def test_json_backends(self, backend):
+        testfile = os.path.join(self.usgs_legend_dir,'mock_usgs_data.json')
+        default_backend = io.getJsonBackend()
+        io.setJsonBackend(backend)
+        try:
+            assert io.loadLegendJson(testfile) == mock_data.get_mock_usgs_legend()
+            assert io._jsonDumps({'label' : 'Qal', 'points' : [[1, 2.5]]}) == '{"label":"Qal","points":[[1,2.5]]}'
+            assert io._jsonLoads(io._jsonDumps({'x' : 1e-5, 'y' : float('nan')})) == {'x' : 1e-5, 'y' : None}
+        finally:
+            io.setJsonBackend(default_backend)
+
+    def test_json_backend_not_installed(self):
+        with pytest.raises(ValueError):
+            io.setJsonBackend('not_a_backend')
+
+    @pytest.mark.parametrize('processes', [None, 2])
+    def test_parallel_load_legends(self, processes):
+        filenames = ['mock_usgs_data.json', '46_Coosa_2015_11 74.json', 'JosCtyOR.json', 'drab_volcano_legend.json']
+        filepaths = [os.path.join(self.usgs_legend_dir, f) for f in filenames]
+        result = io.parallelLoadLegends(filepaths, threads=4, processes=processes)
+        assert list(result.keys()) == [os.path.splitext(f)[0] for f in filenames]
+        assert result['mock_usgs_data'] == mock_data.get_mock_usgs_legend()
+        assert result['JosCtyOR'] == mock_data.get_josCtyOR_legend()
+
+    def test_iter_load_legends(self):
+        filenames = ['mock_usgs_data.json', 'JosCtyOR.json']
+        filepaths = [os.path.join(self.usgs_legend_dir, f) for f in filenames]
+        result = dict(io.iterLoadLegends(filepaths, type_filter=[MapUnitType.POLYGON]))
+        expected = mock_data.get_mock_usgs_legend()
+        [expected.features.remove(f) for f in mock_data.get_mock_usgs_legend().features if f.type != MapUnitType.POLYGON]
+        assert sorted(result.keys()) == ['JosCtyOR', 'mock_usgs_data']
+        assert result['mock_usgs_data'] == expected
 
 def exec_loadLayoutJson(filepath:Path, expected:Layout):
     result = io.loadLayoutJson(filepath)
     assert result == expected
 
 def exec_loadUnchartedLayoutv1Json(filepath:Path, expected:Layout):
-    result = io._loadLegacyUnchartedLayoutv1Json(filepath)
+    result = io._parseLegacyUnchartedLayoutv1Json(io._loadJsonFile(filepath))
     assert result == expected
 
 def exec_loadUnchartedLayoutv2Json(filepath:Path, expected:Layout):
-    result = io._loadLegacyUnchartedLayoutv2Json(filepath)
+    with open(filepath, 'rb') as fh:
+        result = io._parseLegacyUnchartedLayoutv2Json(io._readJsonOrJsonLines(fh.read()))
     assert result == expected
 
 class Test_LayoutData:
@@ -136,13 +175,56 @@ class Test_LayoutData:
         exec_loadUnchartedLayoutv2Json(testfile, expected)
         exec_loadLayoutJson(testfile, expected)
 
+    def test_load_single_record_layout_v2(self, tmp_path):
+        testfile = os.path.join(tmp_path, 'single_record_layout_v2.json')
+        with open(os.path.join(self.layout_dir, 'mock_layout_v2.json'), 'r') as fh:
+            record = fh.readline()
+        with open(testfile, 'w') as fh:
+            fh.write(record)
+        result = io.loadLayoutJson(testfile)
+        assert result.provenance.version == '0.2'
+        assert result.point_legend[0].geometry == [[[17.0, 19.0], [21.0, 20.0], [22.0, 24.0], [23.0, 32.0]]]
+        assert result.line_legend == result.point_legend
+        assert len(result.map) == 0 and len(result.polygon_legend) == 0
+
+    def test_load_invalid_layout(self, tmp_path):
+        testfile = os.path.join(tmp_path, 'invalid_layout.json')
+        with open(testfile, 'w') as fh:
+            fh.write('{"name": "segmentation", "bounds": [[0, 0], ["a", null]], "model": {"field": "map"}, "confidence": "high"}')
+        with pytest.raises(ValidationError):
+            io.loadLayoutJson(testfile)
+
     def test_load_rectify2_layout(self):
         testfile = os.path.join(self.layout_dir, 'rectify2_LawrenceHoffmann.json')
         expected = mock_data.get_rectify2_LawrenceHoffmann_map().layout
         exec_loadUnchartedLayoutv1Json(testfile, expected)
         exec_loadLayoutJson(testfile, expected)
 
-    # TODO ParallelLoadLayouts Test
+    def test_register_layout_format(self, tmp_path):
+        testfile = os.path.join(tmp_path, 'custom_layout.json')
+        with open(testfile, 'w') as fh:
+            fh.write('{"custom_format": true}')
+        expected = mock_data.get_mock_uncharted_layout()
+        format = (lambda json_data: isinstance(json_data, dict) and json_data.get('custom_format'), lambda json_data: expected)
+        io.registerLayoutFormat(*format)
+        try:
+            exec_loadLayoutJson(testfile, expected)
+        finally:
+            io._layout_formats.remove(format)
+
+    @pytest.mark.parametrize('processes', [None, 2])
+    def test_parallel_load_layouts(self, processes):
+        filenames = ['mock_layout_v1.json', 'rectify2_LawrenceHoffmann.json']
+        filepaths = [os.path.join(self.layout_dir, f) for f in filenames]
+        result = io.parallelLoadLayouts(filepaths, threads=4, processes=processes)
+        assert list(result.keys()) == ['mock_layout_v1', 'rectify2_LawrenceHoffmann']
+        assert result['mock_layout_v1'] == mock_data.get_mock_uncharted_layout()
+        assert result['rectify2_LawrenceHoffmann'] == mock_data.get_rectify2_LawrenceHoffmann_map().layout
+
+    def test_iter_load_layouts(self):
+        filepaths = [os.path.join(self.layout_dir, 'mock_layout_v1.json')]
+        result = list(io.iterLoadLayouts(filepaths))
+        assert result == [('mock_layout_v1', mock_data.get_mock_uncharted_layout())]
 
 def exec_loadGeoTiff(filepath:Path, expected:tuple):
     # Just checking if the shape is correct.
@@ -173,6 +255,73 @@ class Test_GeoTiffData:
     #     expected = (3, 15450, 22800)
     #     exec_loadGeoTiff(filepath, expected)
 
+    def test_parallel_load(self, tmp_path):
+        filepaths = [os.path.join(self.geotiff_dir, 'mock_map_data.tif')]
+        for i in range(3):
+            filepaths.append(os.path.join(tmp_path, f'map_{i}.tif'))
+            io.saveGeoTiff(filepaths[-1], np.full((1,40+i,50), i, dtype=np.uint16))
+        expected = [io.loadGeoTiff(filepath) for filepath in filepaths]
+        result = io.parallelLoadGeoTiffs(filepaths, processes=2, max_in_flight=2)
+        assert len(result) == len(expected)
+        for (image, crs, transform), (expected_image, expected_crs, expected_transform) in zip(result, expected):
+            assert image.dtype == expected_image.dtype
+            assert np.array_equal(image, expected_image)
+            assert crs == expected_crs
+            assert transform == expected_transform
+
+    def test_iter_load(self, tmp_path):
+        filepaths = []
+        for i in range(3):
+            filepaths.append(os.path.join(tmp_path, f'map_{i}.tif'))
+            io.saveGeoTiff(filepaths[-1], np.full((1,40,50), i, dtype=np.uint8))
+        result = dict(io.iterLoadGeoTiffs(filepaths, processes=2, max_in_flight=1))
+        assert sorted(result.keys()) == ['map_0', 'map_1', 'map_2']
+        for i in range(3):
+            assert np.all(result[f'map_{i}'][0] == i)
+
+    def test_parallel_load_missing_file(self, tmp_path):
+        filepaths = [os.path.join(self.geotiff_dir, 'mock_map_data.tif'), os.path.join(tmp_path, 'missing.tif')]
+        with pytest.raises(Exception):
+            io.parallelLoadGeoTiffs(filepaths, processes=2)
+
+class Test_RasterCache:
+    geotiff_dir = 'tests/data/images'
+
+    def test_cached_load(self, tmp_path):
+        filepath = os.path.join(self.geotiff_dir, 'mock_map_data.tif')
+        expected_image, expected_crs, expected_transform = io.loadGeoTiff(filepath)
+        cache = io.RasterCache(os.path.join(tmp_path, 'cache'))
+        for _ in range(2):
+            image, crs, transform = io.loadGeoTiff(filepath, cache=cache)
+            assert isinstance(image, np.memmap)
+            assert np.array_equal(image, expected_image)
+            assert crs == expected_crs
+            assert transform == expected_transform
+        assert len([f for f in os.listdir(cache.cache_dir) if f.endswith('.npy')]) == 1
+
+    def test_modified_file_is_reloaded(self, tmp_path):
+        filepath = os.path.join(tmp_path, 'mock_map_data.tif')
+        shutil.copy(os.path.join(self.geotiff_dir, 'mock_map_data.tif'), filepath)
+        cache = io.RasterCache(os.path.join(tmp_path, 'cache'))
+        io.loadGeoTiff(filepath, cache=cache)
+        io.saveGeoTiff(filepath, np.ones((3,100,100), dtype=np.uint8))
+        image, _, _ = io.loadGeoTiff(filepath, cache=cache)
+        assert np.array_equal(image, np.ones((3,100,100), dtype=np.uint8))
+
+    def test_lru_eviction(self, tmp_path):
+        filepaths = []
+        for i in range(3):
+            filepaths.append(os.path.join(tmp_path, f'map_{i}.tif'))
+            io.saveGeoTiff(filepaths[-1], np.full((1,100,100), i, dtype=np.uint8))
+        # Room for two images
+        cache = io.RasterCache(os.path.join(tmp_path, 'cache'), max_bytes=2*(100*100+128))
+        io.loadGeoTiff(filepaths[0], cache=cache)
+        io.loadGeoTiff(filepaths[1], cache=cache)
+        os.utime(os.path.join(cache.cache_dir, f'{cache._key(filepaths[1])}.npy'), (1, 1))
+        io.loadGeoTiff(filepaths[2], cache=cache)
+        cached = sorted(f for f in os.listdir(cache.cache_dir) if f.endswith('.npy'))
+        assert cached == sorted(f'{cache._key(filepaths[i])}.npy' for i in [0, 2])
+
 def exec_loadCMASSMap(image_path:Path, expected:CMAAS_Map, legend_path:Path=None, layout_path:Path=None, georef_path:Path=None, metadata_path:Path=None):
     map_data = io.loadCMAASMapFromFiles(image_path, legend_path, layout_path, georef_path, metadata_path)
     # assert map_data == expected
@@ -197,11 +346,130 @@ class Test_MapData:
         expected.layout = mock_data.get_mock_uncharted_layout()
         exec_loadCMASSMap(os.path.join(self.image_dir, 'mock_map_data.tif'), expected, os.path.join(self.legend_dir, 'mock_usgs_data.json'), os.path.join(self.layout_dir, 'mock_layout_v1.json'))
 
+    def test_load_mock_map_lazy(self):
+        image_path = os.path.join(self.image_dir, 'mock_map_data.tif')
+        map_data = io.loadCMAASMapFromFiles(image_path, os.path.join(self.legend_dir, 'mock_usgs_data.json'), lazy_image=True)
+        assert isinstance(map_data.image, LazyGeoTiff)
+        assert map_data.image.shape == (3,100,100)
+        assert np.array_equal(map_data.image.read(), io.loadGeoTiff(image_path)[0])
+        assert map_data.legend == mock_data.get_mock_usgs_legend()
+
+    def test_iter_load_directory(self, tmp_path):
+        image_dir, legend_dir, layout_dir = [os.path.join(tmp_path, d) for d in ['images', 'legends', 'layouts']]
+        [os.makedirs(d) for d in [image_dir, legend_dir, layout_dir]]
+        for i in range(3):
+            shutil.copy(os.path.join(self.image_dir, 'mock_map_data.tif'), os.path.join(image_dir, f'map_{i}.tif'))
+        shutil.copy(os.path.join(self.legend_dir, 'mock_usgs_data.json'), os.path.join(legend_dir, 'map_0.json'))
+        shutil.copy(os.path.join(self.legend_dir, 'JosCtyOR.json'), os.path.join(legend_dir, 'map_1.json'))
+        shutil.copy(os.path.join(self.layout_dir, 'mock_layout_v1.json'), os.path.join(layout_dir, 'map_1.json'))
+        Path(os.path.join(image_dir, 'notes.txt')).touch()
+
+        maps = {m.name : m for m in io.iterLoadCMAASMapsFromDirectory(image_dir, legend_dir, layout_dir, threads=2, prefetch=1)}
+        assert sorted(maps.keys()) == ['map_0', 'map_1', 'map_2']
+        for map_data in maps.values():
+            assert map_data.image.shape == (3,100,100)
+        assert maps['map_0'].legend == mock_data.get_mock_usgs_legend()
+        assert maps['map_0'].layout is None
+        assert maps['map_1'].legend == mock_data.get_josCtyOR_legend()
+        assert maps['map_1'].layout == mock_data.get_mock_uncharted_layout()
+        assert maps['map_2'].legend is None
+
+    def test_load_mock_map_async(self):
+        image_path = os.path.join(self.image_dir, 'mock_map_data.tif')
+        legend_path = os.path.join(self.legend_dir, 'mock_usgs_data.json')
+        layout_path = os.path.join(self.layout_dir, 'mock_layout_v1.json')
+        expected = io.loadCMAASMapFromFiles(image_path, legend_path, layout_path)
+        result = asyncio.run(io.loadCMAASMapFromFilesAsync(image_path, legend_path, layout_path))
+        assert result.name == expected.name
+        assert np.array_equal(result.image, expected.image)
+        assert result.legend == expected.legend
+        assert result.layout == expected.layout
+        assert result.georef.crs == expected.georef.crs
+
+        result = asyncio.run(io.loadCMAASMapFromFilesAsync(image_path, lazy_image=True))
+        assert isinstance(result.image, LazyGeoTiff)
+        assert result.legend is None
+
+    def test_load_maps_async(self):
+        io.setAsyncExecutor(threads=2)
+        executor = io.getAsyncExecutor()
+        image_path = os.path.join(self.image_dir, 'mock_map_data.tif')
+        map_files = [(image_path, os.path.join(self.legend_dir, 'mock_usgs_data.json'), None), (image_path, None, None)]
+        result = asyncio.run(io.loadCMAASMapsAsync(map_files, max_concurrency=1))
+        assert [m.legend for m in result] == [mock_data.get_mock_usgs_legend(), None]
+        assert io.getAsyncExecutor() is executor
+
+        legend, layout, (image, _, _) = asyncio.run(self._gather_components(image_path))
+        assert legend == mock_data.get_mock_usgs_legend()
+        assert layout == mock_data.get_mock_uncharted_layout()
+        assert image.shape == (3,100,100)
+
+    async def _gather_components(self, image_path):
+        return await asyncio.gather(
+            io.loadLegendJsonAsync(os.path.join(self.legend_dir, 'mock_usgs_data.json')),
+            io.loadLayoutJsonAsync(os.path.join(self.layout_dir, 'mock_layout_v1.json')),
+            io.loadGeoTiffAsync(image_path))
+
     # Rectify2_LawrenceHoffmann
     # def test_load_rectify2(self):
     #     expected = mock_data.get_rectify2_LawrenceHoffmann_map()
     #     exec_loadCMASSMap(os.path.join(self.image_dir, 'rectify2_LawrenceHoffmann.tif'), expected, legend_path=os.path.join(self.legend_dir, 'rectify2_LawrenceHoffmann.json'), layout_path=os.path.join(self.layout_dir, 'rectify2_LawrenceHoffmann.json'))
 
+    def test_save_geopackage(self, tmp_path):
+        map_data = CMAAS_Map(name='mock_map', legend=Legend(provenance=Provenance(name='MockData')))
+        map_data.georef = GeoReference(provenance=Provenance(name='MockData'), crs=CRS.from_epsg(4326), transform=Affine(2.0, 0.0, 10.0, 0.0, -2.0, 20.0))
+        for label, offset in [('unit_a', 0), ('unit_b', 10)]:
+            segmentation = MapUnitSegmentation(provenance=Provenance(name='MockData'), geometry=[shapely.box(offset, 0, offset+1, 1)])
+            map_data.legend.features.append(MapUnit(label=label, type=MapUnitType.POLYGON, segmentation=segmentation))
+        filepath = os.path.join(tmp_path, 'mock_map.gpkg')
+        io.saveGeoPackage(filepath, map_data, coord_type='georef')
+        layer = gpd.read_file(filepath, layer='unit_b')
+        assert layer.geometry[0].bounds == (30.0, 18.0, 32.0, 20.0)
+
+        filepath = os.path.join(tmp_path, 'mock_map_single.gpkg')
+        io.saveGeoPackage(filepath, map_data, single_layer=True)
+        layer = gpd.read_file(filepath, layer='mock_map')
+        assert list(layer['label']) == ['unit_a', 'unit_b']
+        assert list(layer['type']) == ['polygon', 'polygon']
+        assert layer.geometry[1].bounds == (10.0, 0.0, 11.0, 1.0)
+
+    def test_save_geopackage_unlabeled(self, tmp_path):
+        map_data = CMAAS_Map(name='mock_map', legend=Legend(provenance=Provenance(name='MockData')))
+        for label, offset in [('unit_a', 0), (None, 10)]:
+            segmentation = MapUnitSegmentation(provenance=Provenance(name='MockData'), geometry=[shapely.box(offset, 0, offset+1, 1)])
+            map_data.legend.features.append(MapUnit(label=label, type=MapUnitType.POLYGON, segmentation=segmentation))
+        filepath = os.path.join(tmp_path, 'mock_map.gpkg')
+        io.saveGeoPackage(filepath, map_data)
+        assert gpd.read_file(filepath, layer='unit_a').geometry[0].bounds == (0.0, 0.0, 1.0, 1.0)
+        layer = gpd.read_file(filepath, layer='mock_map')
+        assert layer.geometry[0].bounds == (10.0, 0.0, 11.0, 1.0)
+
+    def test_cmaas_map_bundle(self, tmp_path):
+        map_data = io.loadCMAASMapFromFiles(os.path.join(self.image_dir, 'mock_map_data.tif'), legend_path=os.path.join(self.legend_dir, 'mock_usgs_data.json'), layout_path=os.path.join(self.layout_dir, 'mock_layout_v1.json'))
+        map_data.legend.features[0].segmentation = MapUnitSegmentation(provenance=Provenance(name='MockData'), geometry=[shapely.box(0, 0, 5, 5), shapely.box(10, 10, 20, 20)], mask=np.eye(10, dtype=np.uint8))
+        map_data.legend.features[1].segmentation = MapUnitSegmentation(provenance=Provenance(name='MockData'), geometry=shapely.box([0, 30], 0, [1, 40], 1))
+        map_data.segmentations = [MapSegmentation(provenance=Provenance(name='MockData'), type=MapUnitType.POLYGON, image=np.ones((100, 100), dtype=np.uint8))]
+        map_data.metadata = CMAAS_MapMetadata(provenance=Provenance(name='MockData'), title='Mock Map')
+        bundle_dir = os.path.join(tmp_path, 'mock_map_data')
+        io.saveCMAASMapBundle(bundle_dir, map_data)
+        result = io.loadCMAASMapBundle(bundle_dir)
+
+        assert result.name == map_data.name
+        assert isinstance(result.image, np.memmap)
+        assert np.array_equal(result.image, map_data.image)
+        assert result.georef.crs == map_data.georef.crs
+        assert result.georef.transform == map_data.georef.transform
+        assert result.legend == map_data.legend
+        assert result.layout == map_data.layout
+        assert result.metadata == map_data.metadata
+        segmentation = result.legend.features[0].segmentation
+        assert [g.equals(e) for g, e in zip(segmentation.geometry, map_data.legend.features[0].segmentation.geometry)] == [True, True]
+        assert isinstance(result.legend.features[1].segmentation.geometry, np.ndarray)
+        assert np.array_equal(result.legend.features[1].segmentation.geometry_bounds(), [[0, 0, 1, 1], [30, 0, 40, 1]])
+        assert np.array_equal(segmentation.mask, np.eye(10, dtype=np.uint8))
+        assert np.array_equal(result.segmentations[0].image, map_data.segmentations[0].image)
+        assert result.to_dict()['map_name'] == map_data.name
+
     # def test_save_geopackage_pixel(self):
     #     from src.cmaas_utils.types import Provenance
     #     map_data = CMAAS_Map(name='VA_Stanardsville')
@@ -242,4 +510,28 @@ class Test_MapData:
 #     print_2d_array('layout.point_legend', layout.point_legend) if layout.point_legend is not None else None
 #     print_2d_array('layout.line_legend', layout.line_legend) if layout.line_legend is not None else None
 #     print_2d_array('layout.polygon_legend', layout.polygon_legend) if layout.polygon_legend is not None else None
-    
\ No newline at end of file
+    
+class Test_CDRData:
+    def test_save_cdr_feature_results(self, tmp_path):
+        feature_result = cdr.exportMapToCDR(mock_data.get_mock_map(), cog_id='1234')
+        filepath = os.path.join(tmp_path, 'mock_map.json')
+        io.saveCDRFeatureResults(filepath, feature_result)
+        with open(filepath, 'r') as fh:
+            assert fh.read() == feature_result.model_dump_json()
+        assert io.loadCDRFeatureResults(filepath) == feature_result
+
+    def test_save_cdr_feature_results_gzip(self, tmp_path):
+        feature_result = cdr.exportMapToCDR(mock_data.get_mock_map(), cog_id='1234')
+        filepath = os.path.join(tmp_path, 'mock_map.json.gz')
+        io.saveCDRFeatureResults(filepath, feature_result)
+        assert io.loadCDRFeatureResults(filepath) == feature_result
+
+    def test_iter_cdr_feature_results(self, tmp_path):
+        pytest.importorskip('ijson')
+        feature_result = cdr.exportMapToCDR(mock_data.get_mock_map(), cog_id='1234')
+        filepath = os.path.join(tmp_path, 'mock_map.json')
+        io.saveCDRFeatureResults(filepath, feature_result)
+        items = list(io.iterCDRFeatureResults(filepath))
+        assert ('cog_id', '1234') in items
+        assert [item for field, item in items if field == 'polygon_feature_results'] == feature_result.polygon_feature_results
+        assert cdr.convert_cdr_feature_results_stream_to_cmaas_map(items) == cdr.convert_cdr_feature_results_to_cmaas_map(feature_result)
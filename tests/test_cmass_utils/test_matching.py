@@ -0,0 +1,41 @@
+import os
+
+from src.cmaas_utils.types import Legend, MapUnit, MapUnitType, Provenance
+from src.cmaas_utils.matching import LegendMatcher
+import src.cmaas_utils.io as io
+
+def get_reference_legend():
+    legend = Legend(provenance=Provenance(name='test', version='0.1'))
+    legend.features.append(MapUnit(type=MapUnitType.POLYGON, label='Quaternary alluvium', abbreviation='Qal', aliases=['alluvial deposits']))
+    legend.features.append(MapUnit(type=MapUnitType.POLYGON, label='Tertiary basalt', abbreviation='Tb'))
+    legend.features.append(MapUnit(type=MapUnitType.LINE, label='Fault', aliases=['Normal fault']))
+    return legend
+
+class Test_LegendMatcher:
+    def test_exact_match(self):
+        legend = get_reference_legend()
+        matcher = LegendMatcher(legend)
+        result = matcher.match(['QAL', 'normal  fault'])
+        assert result[0] == [(legend.features[0], 1.0)]
+        assert result[1] == [(legend.features[2], 1.0)]
+
+    def test_fuzzy_match(self):
+        legend = get_reference_legend()
+        matcher = LegendMatcher(legend)
+        result = matcher.match(['Quaternary aluvium', 'xyz'], top_k=2)
+        assert result[0][0][0] is legend.features[0]
+        assert 0 < result[0][0][1] < 1
+        assert result[1] == []
+
+    def test_match_type(self):
+        legend = get_reference_legend()
+        matcher = LegendMatcher(legend)
+        result = matcher.match(['fault'], top_k=3, unit_types=[MapUnitType.POLYGON])
+        assert all(map_unit.type == MapUnitType.POLYGON for map_unit, _ in result[0])
+
+    def test_match_legend(self):
+        legend = io.loadLegendJson(os.path.join('tests/data/legends', 'drab_volcano_legend.json'))
+        matcher = LegendMatcher(legend)
+        # Every unit matches one with the same normalized name
+        for map_unit, match, score in matcher.match_legend(legend):
+            assert score == 1.0
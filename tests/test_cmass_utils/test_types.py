@@ -1,5 +1,8 @@
+import time
+import pytest
 import numpy as np
-from src.cmaas_utils.types import AreaBoundary, CMAAS_Map, CMAAS_MapMetadata, GeoReference, Layout, Legend, MapUnit, MapUnitSegmentation, MapUnitType, Provenance
+from rasterio.transform import Affine
+from src.cmaas_utils.types import AreaBoundary, CMAAS_Map, CMAAS_MapMetadata, GeoReference, Layout, LazyGeoTiff, Legend, MapSegmentation, MapUnit, MapUnitSegmentation, MapUnitType, Provenance, RLEArray, SparseMask, construct_model
 import src.cmaas_utils.io as io
 from shapely.geometry import Polygon
 
@@ -27,6 +30,41 @@ class Test_MapUnitSegmentation():
         assert map_unit_segmentation.confidence == 0.95
         assert np.array_equal(map_unit_segmentation.mask, np.array([[1, 0, 1], [0, 1, 0], [1, 0, 1]]))
 
+    def test_geometry_array(self):
+        geometry = [Polygon([[0, 0], [0, 1], [2, 1], [2, 0], [0, 0]]), Polygon([[5, 5], [5, 8], [6, 8], [6, 5], [5, 5]])]
+        map_unit_segmentation = MapUnitSegmentation(provenance=Provenance(name='test'), geometry=geometry)
+        assert np.array_equal(map_unit_segmentation.geometry_area(), [2.0, 3.0])
+        assert np.array_equal(map_unit_segmentation.geometry_bounds(), [[0, 0, 2, 1], [5, 5, 6, 8]])
+
+        map_unit_segmentation.to_geometry_array()
+        assert isinstance(map_unit_segmentation.geometry, np.ndarray)
+        assert map_unit_segmentation.geometry_array() is map_unit_segmentation.geometry
+        assert all(g.equals(e) for g, e in zip(map_unit_segmentation.geometry, geometry))
+
+        transformed = map_unit_segmentation.transform_geometry(Affine(2.0, 0.0, 10.0, 0.0, -2.0, 20.0))
+        assert transformed[0].bounds == (10.0, 18.0, 14.0, 20.0)
+        _, coords, offsets = map_unit_segmentation.geometry_coordinates()
+        assert coords.shape == (10, 2)
+        assert list(offsets[-1]) == [0, 1, 2]
+
+        assert len(MapUnitSegmentation(provenance=Provenance(name='test')).geometry_array()) == 0
+
+    def test_array_field_equality(self):
+        prov = Provenance(name='test')
+        geometry = [Polygon([[0, 0], [0, 1], [2, 1], [2, 0], [0, 0]]), Polygon([[5, 5], [5, 8], [6, 8], [6, 5], [5, 5]])]
+        listed = MapUnitSegmentation(provenance=prov, geometry=geometry, points=np.array([[1.0, 2.0]]), mask=np.eye(3, dtype=np.uint8))
+        arrayed = MapUnitSegmentation(provenance=prov, geometry=np.array(geometry, dtype=object), points=np.array([[1.0, 2.0]]), mask=np.eye(3, dtype=np.uint8))
+        assert listed == arrayed
+        arrayed.points = np.array([[1.0, 3.0]])
+        assert listed != arrayed
+        arrayed.points, arrayed.geometry = listed.points, arrayed.geometry[::-1]
+        assert listed != arrayed
+
+        # Reaches the segmentation through the field wise equality of MapUnit and Legend
+        legend1 = Legend(provenance=prov, features=[MapUnit(type=MapUnitType.POLYGON, label='A', segmentation=listed)])
+        legend2 = Legend(provenance=prov, features=[MapUnit(type=MapUnitType.POLYGON, label='A', segmentation=listed.model_copy(update={'geometry' : np.array(geometry, dtype=object)}))])
+        assert legend1 == legend2
+
 class Test_MapUnit():
     def test_map_unit_creation(self):
         # Create a map unit object
@@ -80,6 +118,69 @@ class Test_Legend():
         assert legend.provenance == prov
         assert legend.features == [map_unit]
 
+    def test_legend_index(self):
+        prov = Provenance(name='test', version='0.1')
+        water = MapUnit(type=MapUnitType.POLYGON, label='Water', abbreviation='W', aliases=['Lake', 'River'])
+        fault = MapUnit(type=MapUnitType.LINE, label='Fault', abbreviation='F')
+        legend = Legend(provenance=prov, features=[water, fault])
+
+        assert legend.get_by_label(' water ') == [water]
+        assert legend.get_by_abbreviation('f') == [fault]
+        assert legend.get_by_alias('LAKE') == [water]
+        assert legend.get_by_type(MapUnitType.LINE) == [fault]
+        assert legend.find('river') == [water]
+        assert legend.map_unit_distr() == {MapUnitType.POLYGON : ['Water'], MapUnitType.LINE : ['Fault']}
+
+        # Index follows changes to the features
+        point = MapUnit(type=MapUnitType.POINT, label='Mine')
+        legend.features.append(point)
+        assert legend.get_by_label('mine') == [point]
+        water.aliases.append('Pond')
+        legend.invalidate_index()
+        assert legend.get_by_alias('pond') == [water]
+
+    def test_legend_index_follows_mutation(self):
+        prov = Provenance(name='test', version='0.1')
+        legend = Legend(provenance=prov, features=[MapUnit(type=MapUnitType.POLYGON, label='A'), MapUnit(type=MapUnitType.POLYGON, label='B')])
+        assert legend.map_unit_distr() == {MapUnitType.POLYGON : ['A', 'B']}
+        assert len(legend.get_by_label('a')) == 1
+
+        # Replace in place
+        c = MapUnit(type=MapUnitType.LINE, label='C')
+        legend.features[0] = c
+        assert legend.get_by_label('c') == [c]
+        assert legend.get_by_label('a') == []
+        assert legend.map_unit_distr() == {MapUnitType.LINE : ['C'], MapUnitType.POLYGON : ['B']}
+
+        # Pop then append keeps the same length
+        legend.features.pop()
+        d = MapUnit(type=MapUnitType.POINT, label='D')
+        legend.features.append(d)
+        assert legend.get_by_label('b') == []
+        assert legend.get_by_label('d') == [d]
+        assert legend.get_by_type(MapUnitType.POLYGON) == []
+        assert legend.map_unit_distr() == {MapUnitType.LINE : ['C'], MapUnitType.POINT : ['D']}
+
+        # Assigning a new list and building without validation
+        e = MapUnit(type=MapUnitType.POLYGON, label='E')
+        legend.features = [e]
+        assert legend.get_by_label('e') == [e]
+        legend.features.sort(key=lambda map_unit: map_unit.label)
+        legend.features.append(c)
+        assert legend.get_by_label('c') == [c]
+        legend = Legend.model_construct(provenance=prov, features=[c])
+        assert legend.get_by_label('c') == [c]
+        legend.features.remove(c)
+        assert legend.get_by_label('c') == []
+
+    def test_legend_equality(self):
+        prov = Provenance(name='test', version='0.1')
+        water = MapUnit(type=MapUnitType.POLYGON, label='Water')
+        fault = MapUnit(type=MapUnitType.LINE, label='Fault')
+        assert Legend(provenance=prov, features=[water, fault]) == Legend(provenance=prov, features=[fault, water])
+        assert Legend(provenance=prov, features=[water, water]) != Legend(provenance=prov, features=[water, fault])
+        assert Legend(provenance=prov, features=[water]) != Legend(provenance=prov, features=[water, fault])
+
 class Test_AreaBoundary():
     def test_area_boundary_creation(self):
         # Create an area boundary object
@@ -89,6 +190,39 @@ class Test_AreaBoundary():
         assert area_boundary.geometry == [[[1, 0, 1], [0, 1, 0], [1, 0, 1]]]
         assert area_boundary.confidence == 0.95
 
+class Test_ConstructModel():
+    def test_trusted_construction(self):
+        geometry = [[[0.0, 1.0], [3.0, 2.0], [4.0, 5.0]]]
+        area = construct_model(AreaBoundary, True, geometry=geometry, confidence=0.5)
+        assert isinstance(area, AreaBoundary)
+        assert area == AreaBoundary(geometry=geometry, confidence=0.5)
+
+        map_unit = construct_model(MapUnit, True, type=MapUnitType.POLYGON, label='Water')
+        assert map_unit == MapUnit(type=MapUnitType.POLYGON, label='Water')
+        assert map_unit.overlay == False
+
+    @pytest.mark.benchmark
+    def test_trusted_construction_benchmark(self):
+        # Large layout of areas as produced by the cdr parsers
+        geometry = np.random.default_rng(0).random((20000, 2)).tolist()
+        sections = {section : [{'geometry' : [geometry], 'confidence' : 0.5} for _ in range(5)] for section in ['map', 'point_legend', 'line_legend', 'polygon_legend']}
+
+        def build(trusted):
+            return construct_model(Layout, trusted, provenance=construct_model(Provenance, trusted, name='test'),
+                **{section : [construct_model(AreaBoundary, trusted, **area) for area in areas] for section, areas in sections.items()})
+
+        def best_time(trusted):
+            times = []
+            for _ in range(3):
+                start = time.perf_counter()
+                build(trusted)
+                times.append(time.perf_counter() - start)
+            return min(times)
+
+        validated_time, trusted_time = best_time(False), best_time(True)
+        assert build(True) == build(False)
+        assert trusted_time * 2 < validated_time
+
 class Test_Layout():
     def test_layout_creation(self):
         # Create a provenance object
@@ -161,6 +295,67 @@ class Test_CMAAS_MapMetadata:
         assert metadata.map_shape == 'rectangle'
         assert metadata.physiographic_region == 'Region'
 
+class Test_CompactArrays:
+    def test_rle_array(self):
+        image = np.zeros((50, 40), dtype=np.int64)
+        image[10:20, 5:30] = 3
+        image[30:45, 0:40] = 300
+        rle = RLEArray(image)
+        assert rle.dtype == np.uint16
+        assert rle.shape == image.shape
+        assert rle.nbytes < image.nbytes
+        assert np.array_equal(np.asarray(rle), image)
+        assert np.array_equal(rle[12:33, 3:8], image[12:33, 3:8])
+        assert np.array_equal(rle[-6], image[-6])
+        assert np.array_equal(rle[::3, 1], image[::3, 1])
+        assert rle.max() == 300
+
+    def test_sparse_mask(self):
+        mask = np.zeros((50, 40), dtype=np.uint8)
+        mask[10:20, 5:30] = 255
+        mask[12, 7] = 0
+        sparse = SparseMask(mask)
+        assert sparse.nbytes < mask.nbytes
+        assert np.array_equal(np.asarray(sparse), mask)
+        assert np.array_equal(sparse[11:13], mask[11:13])
+        assert np.array_equal(SparseMask(np.zeros((5, 5), dtype=bool)).read(), np.zeros((5, 5), dtype=bool))
+
+    def test_compact_map(self):
+        image = np.zeros((50, 40), dtype=np.int64)
+        image[10:20, 5:30] = 1
+        unit_segmentation = MapUnitSegmentation(provenance=Provenance(name='test'), mask=(image == 1).astype(np.uint8))
+        legend = Legend(provenance=Provenance(name='test'), features=[MapUnit(type=MapUnitType.POLYGON, label='unit', segmentation=unit_segmentation)])
+        map_data = CMAAS_Map(name='test', legend=legend, segmentations=[MapSegmentation(provenance=Provenance(name='test'), type=MapUnitType.POLYGON, image=image)])
+        map_data.compact()
+        assert isinstance(map_data.segmentations[0].image, RLEArray)
+        assert isinstance(map_data.legend.features[0].segmentation.mask, SparseMask)
+        assert np.array_equal(np.asarray(map_data.segmentations[0].image), image)
+
+        map_data.segmentations[0].compact('dtype')
+        assert map_data.segmentations[0].image.dtype == np.uint8
+
+class Test_LazyGeoTiff:
+    def test_lazy_geotiff_read(self):
+        image = LazyGeoTiff('tests/data/images/mock_map_data.tif')
+        expected, _, _ = io.loadGeoTiff('tests/data/images/mock_map_data.tif')
+        assert image.shape == expected.shape
+        assert image.dtype == expected.dtype
+        assert np.array_equal(image.read(), expected)
+        assert np.array_equal(np.asarray(image), expected)
+
+    def test_lazy_geotiff_indexing(self):
+        image = LazyGeoTiff('tests/data/images/mock_map_data.tif')
+        expected, _, _ = io.loadGeoTiff('tests/data/images/mock_map_data.tif')
+        for key in [np.s_[:, 10:20, 30:45], np.s_[0], np.s_[1, 5, 6], np.s_[..., -10:], np.s_[:, ::2, 3]]:
+            assert np.array_equal(image[key], expected[key])
+
+    def test_lazy_geotiff_read_window(self):
+        image = LazyGeoTiff('tests/data/images/mock_map_data.tif')
+        expected, _, _ = io.loadGeoTiff('tests/data/images/mock_map_data.tif')
+        window, offset = image.read_window(AreaBoundary(geometry=[[[10,5],[20,5],[20,15],[10,15]]]))
+        assert offset == (10,5)
+        assert np.array_equal(window, expected[:, 5:16, 10:21])
+
 class Test_CMAAS_Map:
     def test_cmaas_map_creation(self):
         # Create a provenance object
@@ -199,6 +394,22 @@ class Test_CMAAS_Map:
         assert cmaas_map.metadata == metadata
         assert cmaas_map.layout == layout
 
+    def test_cmaas_map_to_dict(self):
+        provenance = Provenance(name='test', version='0.1')
+        water = MapUnit(type=MapUnitType.POLYGON, label='Water')
+        cmaas_map = CMAAS_Map(
+            name='Sample Map',
+            layout=Layout(provenance=provenance, map=[AreaBoundary(geometry=[[[0,0],[10,0],[10,10]]])]),
+            legend=Legend(provenance=provenance, features=[water]),
+            georef=GeoReference(provenance=provenance, transform=Affine.identity()))
+        result = cmaas_map.to_dict()
+
+        assert result['legend']['features']['Water'] == water.model_dump()
+        assert result['legend']['provenance'] == {'name' : 'test', 'version' : '0.1'}
+        assert result['layout']['map'] == [{'geometry' : [[[0,0],[10,0],[10,10]]], 'confidence' : None}]
+        assert isinstance(result['georef'], dict)
+        assert result['georef']['transform'] == Affine.identity()
+
     # def test_poly_geometry_generation(self):
     #     map_data = CMAAS_Map(name='VA_Stanardsville')
     #     map_data.legend = io.loadLegendJson('tests/data/legends/VA_Stanardsville.json')
@@ -0,0 +1,184 @@
+import os
+import time
+import pytest
+import rasterio
+import numpy as np
+from shapely.ops import unary_union
+
+from tests.data import mock_data
+from src.cmaas_utils.types import AreaBoundary, MapUnitType
+import src.cmaas_utils.utilities as utilities
+
+def exec_compare_poly_geometry(expected_legend, result_legend):
+    for expected, result in zip(expected_legend.features, result_legend.features):
+        if expected.type != MapUnitType.POLYGON:
+            continue
+        assert len(result.segmentation.geometry) == len(expected.segmentation.geometry)
+        assert unary_union(result.segmentation.geometry).symmetric_difference(unary_union(expected.segmentation.geometry)).area == 0
+
+def exec_time(func, *args, **kwargs):
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+class Test_GeneratePolyGeometry:
+    @pytest.mark.parametrize('noise, noise_threshold', [(0.0, 10), (0.01, 1), (0.02, 5), (0.05, 10), (0.08, 30)])
+    def test_single_pass_matches_per_unit(self, noise, noise_threshold):
+        segmentation = mock_data.get_mock_poly_segmentation(noise=noise)
+        expected = utilities.generate_poly_geometry(segmentation, mock_data.get_mock_poly_legend(), noise_threshold)
+        result = utilities.generate_poly_geometry(segmentation, mock_data.get_mock_poly_legend(), noise_threshold, single_pass=True)
+        exec_compare_poly_geometry(expected, result)
+
+    def test_single_pass_int64_segmentation(self):
+        segmentation = mock_data.get_mock_poly_segmentation()
+        expected = utilities.generate_poly_geometry(segmentation, mock_data.get_mock_poly_legend())
+        segmentation.image = segmentation.image.astype(np.int64)
+        result = utilities.generate_poly_geometry(segmentation, mock_data.get_mock_poly_legend(), single_pass=True)
+        exec_compare_poly_geometry(expected, result)
+
+    @pytest.mark.parametrize('noise, noise_threshold, tile_size', [(0.0, 10, 50), (0.01, 1, 16), (0.02, 5, 33), (0.05, 10, 40), (0.08, 30, 64)])
+    def test_tiled_matches_per_unit(self, noise, noise_threshold, tile_size):
+        segmentation = mock_data.get_mock_poly_segmentation(noise=noise)
+        expected = utilities.generate_poly_geometry(segmentation, mock_data.get_mock_poly_legend(), noise_threshold)
+        result = utilities.generate_poly_geometry(segmentation, mock_data.get_mock_poly_legend(), noise_threshold, tile_size=tile_size)
+        exec_compare_poly_geometry(expected, result)
+
+    def test_tiled_from_file(self, tmp_path):
+        segmentation = mock_data.get_mock_poly_segmentation(noise=0.02)
+        filepath = os.path.join(tmp_path, 'mock_poly_segmentation.tif')
+        with rasterio.open(filepath, 'w', driver='GTiff', height=segmentation.image.shape[0], width=segmentation.image.shape[1],
+                           count=1, dtype=segmentation.image.dtype) as fh:
+            fh.write(segmentation.image, 1)
+        expected = utilities.generate_poly_geometry(segmentation, mock_data.get_mock_poly_legend())
+        result = utilities.generate_poly_geometry_from_file(filepath, mock_data.get_mock_poly_legend(), segmentation.provenance, tile_size=40)
+        exec_compare_poly_geometry(expected, result)
+
+    @pytest.mark.parametrize('tile_size', [None, 40])
+    def test_parallel_matches_serial(self, tile_size):
+        segmentation = mock_data.get_mock_poly_segmentation(noise=0.02)
+        expected = utilities.generate_poly_geometry(segmentation, mock_data.get_mock_poly_legend(), tile_size=tile_size)
+        result = utilities.generate_poly_geometry(segmentation, mock_data.get_mock_poly_legend(), tile_size=tile_size, workers=2)
+        for expected_unit, result_unit in zip(expected.features, result.features):
+            if expected_unit.type != MapUnitType.POLYGON:
+                continue
+            assert [g.wkb for g in result_unit.segmentation.geometry] == [g.wkb for g in expected_unit.segmentation.geometry]
+
+    def test_per_unit_geometry_in_image_coordinates(self):
+        segmentation = mock_data.get_mock_poly_segmentation(noise=0.0)
+        segmentation.image[:] = 0
+        segmentation.image[20:30, 40:45] = 2
+        result = utilities.generate_poly_geometry(segmentation, mock_data.get_mock_poly_legend())
+        assert result.features[0].segmentation.geometry == []
+        assert len(result.features[1].segmentation.geometry) == 1
+        assert result.features[1].segmentation.geometry[0].bounds == (40.0, 20.0, 45.0, 30.0)
+
+    def test_per_unit_geometry_band_axis_and_nodata(self):
+        segmentation = mock_data.get_mock_poly_segmentation(noise=0.02)
+        segmentation.image[0, 0] = 0
+        segmentation.image[-1, -1] = 0
+        expected = utilities.generate_poly_geometry(segmentation, mock_data.get_mock_poly_legend())
+        segmentation.image = segmentation.image[None].astype(np.int32)
+        segmentation.image[0, 0, 0] = -1
+        segmentation.image[0, -1, -1] = 65535
+        result = utilities.generate_poly_geometry(segmentation, mock_data.get_mock_poly_legend())
+        exec_compare_poly_geometry(expected, result)
+
+    @pytest.mark.benchmark
+    @pytest.mark.parametrize('mode', [{'single_pass' : True}, {'tile_size' : 512}])
+    def test_noisy_mask_faster_than_per_unit(self, mode):
+        # Large mask with speckle noise of every label, as real segmentations have
+        segmentation = mock_data.get_mock_poly_segmentation(noise=0.02, shape=(1500,1500), num_units=30)
+        per_unit_time = exec_time(utilities.generate_poly_geometry, segmentation, mock_data.get_mock_poly_legend(30))
+        mode_time = exec_time(utilities.generate_poly_geometry, segmentation, mock_data.get_mock_poly_legend(30), **mode)
+        assert mode_time < per_unit_time
+
+class Test_FindLabelBounds:
+    def test_find_label_bounds(self):
+        image = np.zeros((10,12), dtype=np.uint8)
+        image[2:5, 3:4] = 1
+        image[7, 0] = 1
+        image[0:10, 11] = 3
+        result = utilities.find_label_bounds(image, block_size=3)
+        assert result == {
+            0 : (slice(0,10), slice(0,11)),
+            1 : (slice(2,8), slice(0,4)),
+            3 : (slice(0,10), slice(11,12))
+        }
+
+    def test_find_label_bounds_ignores_other_values(self):
+        image = np.full((10,12), 65535, dtype=np.uint16)
+        image[2:5, 3:4] = 1
+        image[0:10, 11] = 3
+        result = utilities.find_label_bounds(image, [1, 2, 3], block_size=3)
+        assert result == {1 : (slice(2,5), slice(3,4)), 3 : (slice(0,10), slice(11,12))}
+
+        image = image.astype(np.int32)
+        image[image == 65535] = -1
+        assert utilities.find_label_bounds(image, [1, 2, 3]) == result
+        assert utilities.find_label_bounds(image[None])[-1] == (slice(0,10), slice(0,11))
+
+    def test_find_label_bounds_rejects_multiband(self):
+        with pytest.raises(ValueError):
+            utilities.find_label_bounds(np.zeros((2,10,12), dtype=np.uint8))
+
+class Test_GeneratePointGeometry:
+    def test_pixel_points(self):
+        legend = mock_data.get_drab_volcano_legend()
+        segmentation = mock_data.get_mock_poly_segmentation(noise=0.0)
+        segmentation.image[:] = 0
+        segmentation.image[10, 20:22] = 1
+        segmentation.image[30, 5] = 2
+        result = utilities.generate_point_geometry(segmentation, legend)
+
+        assert np.array_equal(result.features[0].segmentation.points, [[20, 10], [21, 10]])
+        assert np.array_equal(result.features[1].segmentation.points, [[5, 30]])
+        for feature in result.features[2:]:
+            assert feature.segmentation.points.shape == (0, 2)
+            assert feature.segmentation.geometry is None
+
+    def test_connected_component_points(self):
+        legend = mock_data.get_drab_volcano_legend()
+        segmentation = mock_data.get_mock_poly_segmentation(noise=0.0)
+        segmentation.image[:] = 0
+        segmentation.image[10:13, 20:23] = 1 # 3x3 symbol of unit 1
+        segmentation.image[50, 60:64] = 1 # 1x4 symbol of unit 1
+        segmentation.image[30:32, 5:7] = 2 # 2x2 symbol of unit 2
+        segmentation.image[32:34, 5:7] = 3 # Touches the unit 2 symbol
+        result = utilities.generate_point_geometry(segmentation, legend, connected_components=True, component_stats=True)
+
+        unit1 = result.features[0].segmentation
+        assert np.array_equal(unit1.points, [[21.0, 11.0], [61.5, 50.0]])
+        assert np.array_equal(unit1.point_sizes, [9, 4])
+        assert np.array_equal(unit1.point_bboxes, [[20, 10, 22, 12], [60, 50, 63, 50]])
+        unit2 = result.features[1].segmentation
+        assert np.array_equal(unit2.points, [[5.5, 30.5]])
+        unit3 = result.features[2].segmentation
+        assert np.array_equal(unit3.points, [[5.5, 32.5]])
+        assert np.array_equal(unit3.point_bboxes, [[5, 32, 6, 33]])
+        for feature in result.features[3:]:
+            assert feature.segmentation.points.shape == (0, 2)
+            assert feature.segmentation.point_sizes.shape == (0,)
+
+class Test_MaskAndCrop:
+    def test_mask_and_crop(self):
+        image = np.arange(3*40*50, dtype=np.uint16).reshape(3,40,50)
+        areas = [AreaBoundary(geometry=[[[10,5],[20,5],[20,15],[10,15]]]), AreaBoundary(geometry=[[[45,30],[60,30],[60,50],[45,50]]])]
+        result, offset = utilities.mask_and_crop(image, areas)
+        assert offset == (10,5)
+        assert result.shape == (3,35,40)
+        assert result.dtype == image.dtype
+        assert np.array_equal(result[:, 0:11, 0:11], image[:, 5:16, 10:21])
+        assert np.array_equal(result[:, 25:35, 35:40], image[:, 30:40, 45:50])
+        assert result[:, 12:25, :].sum() == 0
+
+    def test_mask_and_crop_keeps_dtype(self):
+        for dtype in [np.int8, np.uint8, np.int16, np.float32, bool]:
+            image = np.ones((2,40,50), dtype=dtype)
+            result, _ = utilities.mask_and_crop(image, [AreaBoundary(geometry=[[[10,5],[20,5],[20,15],[10,15]]])])
+            assert result.dtype == image.dtype
+
+    def test_mask_and_crop_outside_image(self):
+        image = np.ones((1,40,50), dtype=np.uint8)
+        result, offset = utilities.mask_and_crop(image, [AreaBoundary(geometry=[[[60,60],[70,60],[70,70]]])])
+        assert offset == (0,0)
+        assert result.shape == (1,0,0)